@@ -1,18 +1,21 @@
 import copy
+import hashlib
 import json
 import os
 import tempfile
 import threading
+from collections import OrderedDict
 
 import psutil as psutil
 # WARNING! Do not remove below import line. PyInstaller depends on it
 from engineio import async_threading
-from flask import Flask, request, Response, send_file
+from flask import Flask, request, Response, send_file, g
 from flask_socketio import SocketIO
 
-from halocoin import tools, engine, custom
+from halocoin import tools, engine, custom, blockfile
 from halocoin.blockchain import BlockchainService
-from halocoin.service import Service
+from halocoin.light import LightService
+from halocoin.service import Service, lockit
 
 async_threading  # PyCharm automatically removes unused imports. This prevents it
 
@@ -25,6 +28,41 @@ class ComplexEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class BlockCache:
+    """
+    Serialized blocks that are deep enough in the chain to not change anymore.
+    Entries carry the hash of the block they were made from. An entry is served only
+    if the block at that length still has the same hash, so a reorg can never leak an old block.
+    """
+
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    @lockit('block_cache')
+    def get(self, length, block_hash):
+        entry = self.entries.get(length, None)
+        if entry is None or entry[0] != block_hash:
+            return None
+        self.entries.move_to_end(length)
+        return entry[1]
+
+    @lockit('block_cache')
+    def put(self, length, block_hash, text):
+        self.entries[length] = (block_hash, text)
+        self.entries.move_to_end(length)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @lockit('block_cache')
+    def evict_from(self, length):
+        for key in [key for key in self.entries.keys() if key >= length]:
+            del self.entries[key]
+
+
+block_cache = BlockCache()
+
+
 def blockchain_synced(func):
     def wrapper(*args, **kwargs):
         if engine.instance.blockchain.get_chain_state() == BlockchainService.IDLE:
@@ -44,6 +82,43 @@ socketio = SocketIO(app, async_mode='threading')
 listen_thread = None
 
 
+def read_snapshot():
+    """
+    Database snapshot that serves current request. Every read of a request sees the same chain length
+    and none of them waits for block import.
+    """
+    if 'snapshot' not in g:
+        g.snapshot = engine.instance.db.reader()
+    return g.snapshot
+
+
+def light_unwatched(addresses):
+    """
+    A light node knows only the accounts and histories of its watched addresses.
+    :param addresses: Requested addresses
+    :return: Error response if light mode runs and some addresses are not watched, None otherwise
+    """
+    if engine.instance.light.get_state() != Service.RUNNING:
+        return None
+    watched = set(engine.instance.light.watched_addresses())
+    unwatched = [address for address in addresses if address not in watched]
+    if len(unwatched) == 0:
+        return None
+    return generate_json_response({
+        "success": False,
+        "error": "Addresses are not watched by this light node",
+        "addresses": unwatched
+    })
+
+
+@app.after_request
+def add_height_header(response):
+    snapshot = g.get('snapshot', None) or engine.instance.db.reader()
+    if snapshot is not None:
+        response.headers['X-Halocoin-Height'] = str(snapshot.length)
+    return response
+
+
 def shutdown_server():
     func = request.environ.get('werkzeug.server.shutdown')
     if func is None:
@@ -125,7 +200,8 @@ def info_wallet():
     if encrypted_wallet_content is not None:
         try:
             wallet = Wallet.from_string(tools.decrypt(password, encrypted_wallet_content))
-            account = engine.instance.statedb.get_account(wallet.address, apply_tx_pool=False)
+            length, accounts = engine.instance.statedb.get_accounts([wallet.address], read_snapshot())
+            account = accounts[wallet.address]
             return generate_json_response({
                 "name": wallet.name,
                 "pubkey": wallet.get_pubkey_str(),
@@ -204,7 +280,12 @@ def wallets():
 
 @app.route('/peers', methods=['GET', 'POST'])
 def peers():
-    return generate_json_response(engine.instance.clientdb.get_peers())
+    peers = engine.instance.clientdb.get_peers()
+    for peer in peers:
+        peer_history = engine.instance.clientdb.get_peer_history(peer['node_id'])
+        peer['stats'] = {key: peer_history[key] for key in ['bytes_raw', 'bytes_wire', 'rtt', 'throughput',
+                                                              'success_rate', 'useful_blocks', 'penalty']}
+    return generate_json_response(peers)
 
 
 @app.route('/node_id', methods=['GET', 'POST'])
@@ -240,22 +321,57 @@ def history():
             encrypted_wallet_content = engine.instance.clientdb.get_wallet(wallet_name)
             wallet = Wallet.from_string(tools.decrypt(password, encrypted_wallet_content))
             address = wallet.address
-    account = engine.instance.statedb.get_account(wallet.address)
+    if address is None or not tools.is_address_valid(address):
+        return generate_json_response({
+            "success": False,
+            "error": "Invalid address"
+        })
+    unwatched = light_unwatched([address])
+    if unwatched is not None:
+        return unwatched
+    direction = request.values.get('direction', None)
+    reverse = request.values.get('order', 'desc') != 'asc'
+    try:
+        limit = max(1, min(int(request.values.get('limit', 50)), 500))
+        cursor = request.values.get('cursor', None)
+        after = tuple(map(int, cursor.split('_'))) if cursor else None
+    except ValueError:
+        return generate_json_response({
+            "success": False,
+            "error": "Invalid limit or cursor"
+        })
+
     txs = {
         "send": [],
-        "recv": []
+        "recv": [],
+        "next": None
     }
-    for block_index in reversed(account['tx_blocks']):
-        block = engine.instance.blockchain.get_block(block_index)
-        for tx in block['txs']:
-            if tx['type'] == 'mint':
+    block = None
+    count = 0
+    entries = engine.instance.statedb.get_history(address, reverse, after, read_snapshot())
+    for block_index, tx_index, directions in entries:
+        if direction is not None and direction not in directions:
+            continue
+        if count == limit:
+            # There is at least one more entry. Client continues from the last returned one.
+            txs['next'] = '{}_{}'.format(*after)
+            break
+        if block is None or block['length'] != block_index:
+            block = read_snapshot().get(BlockchainService.block_key(block_index))
+        if block is not None:
+            tx = block['txs'][tx_index]
+        else:
+            # Light mode has no blocks, only verified txs of watched addresses.
+            tx = read_snapshot().get(LightService.tx_key(block_index, tx_index))
+            if tx is None:
                 continue
-            tx['block'] = block_index
-            owner = tools.tx_owner_address(tx)
-            if owner == address:
-                txs['send'].append(tx)
-            elif tx['type'] == 'spend' and tx['to'] == address:
-                txs['recv'].append(tx)
+        tx['block'] = block_index
+        if 'send' in directions and direction != 'recv':
+            txs['send'].append(tx)
+        else:
+            txs['recv'].append(tx)
+        after = (block_index, tx_index)
+        count += 1
     return generate_json_response(txs)
 
 
@@ -319,18 +435,25 @@ def send():
 
 @app.route('/blockcount', methods=['GET', 'POST'])
 def blockcount():
-    result = dict(length=engine.instance.db.get('length'),
+    result = dict(length=read_snapshot().length,
                   known_length=engine.instance.clientdb.get('known_length'))
     result_text = json.dumps(result)
     return Response(response=result_text, headers={"Content-Type": "application/json"})
 
 
+@app.route('/intake_stats', methods=['GET', 'POST'])
+def intake_stats():
+    stats = engine.instance.blockchain.blocks_queue.get_stats()
+    stats['orphans'] = engine.instance.blockchain.orphans.get_stats()
+    return generate_json_response(stats)
+
+
 @app.route('/mempool', methods=['GET', 'POST'])
 def mempool():
     purge = request.values.get('purge', None)
     if purge is not None:
         engine.instance.blockchain.tx_pool_pop_all()
-    pool = copy.deepcopy(engine.instance.blockchain.tx_pool())
+    pool = copy.deepcopy(engine.instance.blockchain.tx_pool_view())
     for i, tx in enumerate(pool):
         pool[i]['from'] = tools.tx_owner_address(tx)
 
@@ -341,7 +464,7 @@ def mempool():
 def blocks():
     start = int(request.values.get('start', '-1'))
     end = int(request.values.get('end', '-1'))
-    length = engine.instance.db.get('length')
+    length = read_snapshot().length
     if start == -1 and end == -1:
         end = length
         start = max(end - 20, 0)
@@ -350,20 +473,74 @@ def blocks():
     elif end == -1:
         end = min(length, start + 20)
 
-    result = {
-        "start": start,
-        "end": end,
-        "blocks": []
-    }
+    snapshot = read_snapshot()
+    hashes = [snapshot.get(BlockchainService.block_hash_key(i)) for i in range(start, min(end, length) + 1)]
+    etag = None
+    if None not in hashes:
+        # Same range of the same blocks always produces the same response.
+        etag = hashlib.sha256('{}_{}_'.format(start, end).encode() + b''.join(hashes)).hexdigest()
+        if etag in request.if_none_match:
+            return Response(status=304, headers={"ETag": '"{}"'.format(etag)})
+
+    block_cache.max_size = engine.instance.config.get('api', {}).get('cache_size', 5000)
+    confirmations = engine.instance.config.get('api', {}).get('cache_confirmations', 6)
+    texts = []
     for i in range(start, end + 1):
-        block = engine.instance.blockchain.get_block(i)
-        if block is None:
-            break
-        mint_tx = list(filter(lambda t: t['type'] == 'mint', block['txs']))[0]
-        block['miner'] = tools.tx_owner_address(mint_tx)
-        result["blocks"].append(block)
-    result["blocks"] = list(reversed(result["blocks"]))
-    return generate_json_response(result)
+        block_hash = hashes[i - start] if i - start < len(hashes) else None
+        text = block_cache.get(i, block_hash) if block_hash is not None else None
+        if text is None:
+            block = snapshot.get(BlockchainService.block_key(i))
+            if block is None:
+                break
+            mint_tx = list(filter(lambda t: t['type'] == 'mint', block['txs']))[0]
+            block['miner'] = tools.tx_owner_address(mint_tx)
+            text = json.dumps(block, cls=ComplexEncoder)
+            if block_hash is not None and i <= length - confirmations:
+                block_cache.put(i, block_hash, text)
+        texts.append(text)
+    result_text = '{{"start": {}, "end": {}, "blocks": [{}]}}'.format(start, end, ', '.join(reversed(texts)))
+    headers = {"Content-Type": "application/json"}
+    if etag is not None:
+        headers["ETag"] = '"{}"'.format(etag)
+    return Response(response=result_text, headers=headers)
+
+
+@app.route('/export_blocks', methods=['GET', 'POST'])
+def export_blocks():
+    """
+    Stream a range of blocks without holding them in memory.
+    format=ndjson gives one JSON encoded block per line. format=binary gives a block file
+    that can be imported by another node.
+    """
+    snapshot = read_snapshot()
+    try:
+        start = max(0, int(request.values.get('start', '0')))
+        end = int(request.values.get('end', str(snapshot.length)))
+    except ValueError:
+        return generate_json_response({
+            "success": False,
+            "error": "Invalid range"
+        })
+    export_format = request.values.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'binary'):
+        return generate_json_response({
+            "success": False,
+            "error": "Format must be ndjson or binary"
+        })
+
+    def generate():
+        records = snapshot.iterate(BlockchainService.block_key(start), BlockchainService.block_key(end + 1),
+                                   raw=(export_format == 'binary'))
+        if export_format == 'binary':
+            yield blockfile.MAGIC
+            for key, payload in records:
+                yield blockfile.encode_record(int(key[len('block_'):]), payload)
+        else:
+            for key, block in records:
+                yield json.dumps(block, cls=ComplexEncoder) + '\n'
+
+    mimetype = 'application/octet-stream' if export_format == 'binary' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype)
 
 
 @app.route('/difficulty', methods=['GET', 'POST'])
@@ -387,8 +564,137 @@ def balance():
             wallet = Wallet.from_string(tools.decrypt(password, encrypted_wallet_content))
             address = wallet.address
 
-    account = engine.instance.statedb.get_account(address, apply_tx_pool=False)
-    return generate_json_response({'balance': account['amount']})
+    if address is None or not tools.is_address_valid(address):
+        return generate_json_response({
+            "success": False,
+            "error": "Invalid address"
+        })
+    unwatched = light_unwatched([address])
+    if unwatched is not None:
+        return unwatched
+    length, accounts = engine.instance.statedb.get_accounts([address], read_snapshot())
+    return generate_json_response({'balance': accounts[address]['amount']})
+
+
+@app.route('/balances', methods=['GET', 'POST'])
+def balances():
+    """
+    Balances of many addresses at once. Addresses are given either as a JSON list in request body
+    or as a comma separated 'addresses' parameter. Every balance is read at the same chain length.
+    """
+    json_body = request.get_json(silent=True)
+    if isinstance(json_body, dict):
+        json_body = json_body.get('addresses', None)
+    if isinstance(json_body, list):
+        addresses = [str(address) for address in json_body]
+    else:
+        addresses = [address for address in request.values.get('addresses', '').split(',') if address != '']
+
+    max_addresses = engine.instance.config.get('api', {}).get('max_addresses', 10000)
+    if len(addresses) > max_addresses:
+        return generate_json_response({
+            "success": False,
+            "error": "At most {} addresses can be queried at once".format(max_addresses)
+        })
+    invalid = [address for address in addresses if not tools.is_address_valid(address)]
+    if len(invalid) > 0:
+        return generate_json_response({
+            "success": False,
+            "error": "Invalid addresses",
+            "addresses": invalid
+        })
+    unwatched = light_unwatched(addresses)
+    if unwatched is not None:
+        return unwatched
+
+    length, accounts = engine.instance.statedb.get_accounts(addresses, read_snapshot())
+    return generate_json_response({
+        "length": length,
+        "balances": {address: {'balance': account['amount'], 'count': account['count']}
+                     for address, account in accounts.items()}
+    })
+
+
+@app.route('/tx_proof', methods=['GET', 'POST'])
+def tx_proof():
+    """
+    Inclusion proof of a tx in a block. Tx is given by block length and either its short hash or index.
+    Proof is checked with tools.verify_tx_proof against txRoot of the returned header.
+    """
+    snapshot = read_snapshot()
+    try:
+        length = int(request.values.get('length', None))
+        index = request.values.get('index', None)
+        index = int(index) if index is not None else None
+    except (TypeError, ValueError):
+        return generate_json_response({
+            "success": False,
+            "error": "Block length and tx index must be integers"
+        })
+    block = snapshot.get(BlockchainService.block_key(length))
+    if block is None or 'txRoot' not in block:
+        return generate_json_response({
+            "success": False,
+            "error": "Block does not exist or does not commit to its txs"
+        })
+    tx_hash = request.values.get('tx_hash', None)
+    if index is None and tx_hash is not None:
+        index = next((i for i, tx in enumerate(block['txs']) if tools.tx_hash(tx) == tx_hash), None)
+    if index is None or not 0 <= index < len(block['txs']):
+        return generate_json_response({
+            "success": False,
+            "error": "Tx is not in block"
+        })
+    header = tools.block_header(block)
+    header['nonce'] = block['nonce']
+    return generate_json_response({
+        "length": length,
+        "index": index,
+        "tx": block['txs'][index],
+        "header": header,
+        "proof": tools.tx_merkle_proof(block['txs'], index)
+    })
+
+
+@app.route('/state_proof', methods=['GET', 'POST'])
+def state_proof():
+    """
+    Membership proof of an account against the state root at the snapshot length.
+    Proof is checked with smt.verify_proof. Siblings run from the root downwards. For an address
+    without account, leaf is the account that sits on its path, if there is one.
+    """
+    address = request.values.get('address', None)
+    if address is None:
+        return generate_json_response({
+            "success": False,
+            "error": "Address is required"
+        })
+    if not tools.is_address_valid(address):
+        return generate_json_response({
+            "success": False,
+            "error": "Invalid address"
+        })
+    snapshot = read_snapshot()
+    account = snapshot.get(address)
+    proof = engine.instance.statedb.tree.proof(address, snapshot)
+    return generate_json_response({
+        "length": snapshot.length,
+        "root": engine.instance.statedb.tree.root(snapshot),
+        "address": address,
+        "account": None if account is None else {'amount': account['amount'], 'count': account['count']},
+        "siblings": proof['siblings'],
+        "leaf": proof['leaf']
+    })
+
+
+@app.route('/state_root', methods=['GET', 'POST'])
+def state_root():
+    snapshot = read_snapshot()
+    length = int(request.values.get('length', str(snapshot.length)))
+    return generate_json_response({
+        "length": length,
+        "root": engine.instance.statedb.get_state_root(length, snapshot)
+    })
 
 
 @app.route('/stop', methods=['GET', 'POST'])
@@ -463,6 +769,10 @@ def new_block():
     socketio.emit('new_block')
 
 
+def removed_block(length):
+    block_cache.evict_from(length)
+
+
 def peer_update():
     socketio.emit('peer_update')
 
@@ -1,10 +1,12 @@
 import copy
+import queue
 import threading
 import time
 from cdecimal import Decimal
 
 from halocoin import custom, api
 from halocoin import tools
+from halocoin.intake import BlockIntake, OrphanPool
 from halocoin.ntwrk import Response
 from halocoin.service import Service, threaded, sync, NoExceptionQueue, lockit
 
@@ -26,9 +28,13 @@ class BlockchainService(Service):
     def __init__(self, engine):
         Service.__init__(self, name='blockchain')
         self.engine = engine
-        self.blocks_queue = NoExceptionQueue(3)
+        self.blocks_queue = BlockIntake(self.engine.config.get('blockchain', {}).get('intake_size', 2000))
+        # Candidates that passed stateless checks wait here for blockchain_process.
+        self.orphans = OrphanPool(self.engine.config.get('blockchain', {}).get('orphan_size', 500))
+        self.verified_queue = queue.Queue(self.engine.config.get('blockchain', {}).get('pipeline_depth', 4))
         self.tx_queue = NoExceptionQueue(100)
         self.mempool = []
+        self.mempool_index = {}
         self.db = None
         self.statedb = None
         self.clientdb = None
@@ -36,19 +42,28 @@ class BlockchainService(Service):
         self.addLock = threading.RLock()
 
     def on_register(self):
+        self.bind_databases()
+        print("Started Blockchain")
+        return True
+
+    def bind_databases(self):
         self.db = self.engine.db
         self.statedb = self.engine.statedb
         self.clientdb = self.engine.clientdb
-        print("Started Blockchain")
-        return True
 
     @threaded
-    @lockit('write_kvstore')
-    def blockchain_process(self):
+    def block_verifier(self):
         """
-        In this thread we check blocks queue for possible additions to blockchain.
-        Following type is expected to come out of the queue. Any other type will be rejected.
-        ([candidate_blocks in order], peer_node_id)
+        First stage of block import. Candidates are taken from blocks queue and checked
+        without touching chain state: integrity, proof of work and tx signatures.
+        Valid blocks are passed to verified queue in batches of verify_batch blocks, so that
+        blockchain_process applies a batch while the next one of the same candidate is verified.
+        Putting into verified queue blocks when it is full, which holds this stage back until
+        state updates catch up.
+        Following type is expected to come out of blocks queue.
+        ([candidate_blocks in order], peer_node_id, intake_keys)
+        Batches go into verified queue as ([blocks], peer_node_id, intake_keys or None, is_last).
+        Intake keys come with the last batch of a candidate.
         Only 3 services actually put stuff in queue: peer_listen, peer_check, miner
         PeerListen and PeerCheck obeys the expected style.
         Miner instead puts one block in candidate block list, node id is 'miner'
@@ -56,51 +71,107 @@ class BlockchainService(Service):
         """
         try:
             candidate = self.blocks_queue.get(timeout=0.1)
-            self.set_chain_state(BlockchainService.SYNCING)
+        except queue.Empty:
+            return
+
+        blocks, node_id, keys = candidate
+        batch_size = self.engine.config.get('blockchain', {}).get('verify_batch', 16)
+        sent = False
+        finished = False
+        try:
+            if isinstance(blocks, list) and len(blocks) > 0:
+                failed = False
+                for start in range(0, len(blocks), batch_size):
+                    batch = []
+                    for block in blocks[start:start + batch_size]:
+                        if not BlockchainService.block_integrity_check(block) or \
+                                not BlockchainService.block_stateless_check(block):
+                            # Later blocks cannot be connected without this one.
+                            failed = True
+                            break
+                        batch.append(block)
+                    last = failed or start + batch_size >= len(blocks)
+                    if len(batch) > 0 or (last and sent):
+                        if not self.put_verified((batch, node_id, keys if last else None, last)):
+                            break
+                        sent = True
+                        finished = last
+                    if last:
+                        break
+
+                if failed and node_id != 'miner':
+                    self.peer_reported_false_blocks(node_id)
+        except Exception as e:
+            tools.log(e)
+        if not sent:
+            self.blocks_queue.release(keys)
+        elif not finished:
+            # blockchain_process is waiting for the rest of this candidate.
+            self.put_verified(([], node_id, keys, True))
+
+    def put_verified(self, item):
+        """
+        :return: Whether item is queued. False if service is stopping.
+        """
+        while self.threaded_running():
             try:
-                if isinstance(candidate, tuple):
-                    blocks = candidate[0]
-                    node_id = candidate[1]
-                    total_number_of_blocks_added = 0
+                self.verified_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-                    for block in blocks:
-                        if not BlockchainService.block_integrity_check(block) and node_id != 'miner':
-                            self.peer_reported_false_blocks(node_id)
-                            return
+    def next_verified(self, timeout=None):
+        """
+        :param timeout: Seconds to wait. None waits until an item arrives or service stops.
+        :return: Next item of verified queue or None
+        """
+        while self.threaded_running():
+            try:
+                item = self.verified_queue.get(timeout=0.1 if timeout is None else timeout)
+                self.verified_queue.task_done()
+                return item
+            except queue.Empty:
+                if timeout is not None:
+                    return None
+        return None
 
-                    self.db.simulate()
-                    try:
-                        length = self.db.get('length')
-                        for i in range(20):
-                            block = self.get_block(length)
-                            if self.fork_check(blocks, length, block):
-                                self.delete_block()
-                                length -= 1
-                            else:
-                                break
-
-                        for block in blocks:
-                            add_block_result = self.add_block(block)
-                            if add_block_result == 2:  # A block that is ahead of us could not be added. No need to proceed.
-                                break
-                            elif add_block_result == 0:
-                                total_number_of_blocks_added += 1
-                                api.new_block()
-                    except Exception as e:
-                        print("halo")
-
-                    if total_number_of_blocks_added == 0 or self.db.get('length') != blocks[-1]['length']:
-                        # All received blocks failed. Punish the peer by lowering rank.
-                        self.db.rollback()
-                        if node_id != 'miner':
-                            self.peer_reported_false_blocks(node_id)
-                    else:
-                        self.db.commit()
+    @threaded
+    @lockit('write_kvstore')
+    def blockchain_process(self):
+        """
+        Second stage of block import. Batches coming out of verified queue already passed
+        stateless checks in block_verifier. Here we resolve forks, apply blocks to state and commit.
+        Later batches of a candidate are taken as soon as they are verified, while block_verifier
+        goes on with the ones after them.
+        After new blocks are committed, orphans waiting for our new top block are connected.
+        :return:
+        """
+        item = self.next_verified(timeout=0.1)
+        if item is not None:
+            self.set_chain_state(BlockchainService.SYNCING)
+            blocks, node_id, keys, last = item
+            candidate = {'keys': keys, 'last': last}
+
+            def next_batch():
+                if candidate['last']:
+                    return None
+                batch, _, candidate['keys'], candidate['last'] = self.next_verified() or ([], None, None, True)
+                return batch
+
+            try:
+                added = self.process_blocks(blocks, node_id, next_batch)
+                while added > 0:
+                    blocks, node_id = self.orphans.pop_chain(self.get_block_hash(self.db.get('length')))
+                    if len(blocks) == 0:
+                        break
+                    added = self.process_blocks(blocks, node_id)
             except Exception as e:
                 tools.log(e)
-            self.blocks_queue.task_done()
-        except:
-            pass
+            # Batches of a candidate that were not needed are dropped.
+            while next_batch() is not None:
+                pass
+            self.blocks_queue.release(candidate['keys'] or [])
 
         try:
             candidate_tx = self.tx_queue.get(timeout=0.1)
@@ -111,6 +182,89 @@ class BlockchainService(Service):
 
         self.set_chain_state(BlockchainService.IDLE)
 
+    def process_blocks(self, blocks, node_id, next_batch=None):
+        """
+        Apply verified blocks to the chain. Blocks that are ahead of our chain are kept in orphan
+        pool until their parent arrives.
+        Blocks can come in batches. Blocks that extend our chain are committed after every batch.
+        A fork is applied in the same simulation as the unwinding of our chain and committed
+        once it has more work than our chain, so a failed or lighter fork leaves our chain untouched.
+        :param blocks: Consecutive blocks that passed stateless checks
+        :param node_id: Where blocks came from
+        :param next_batch: Function that gives the following blocks of the same candidate, None after the last
+        :return: Number of blocks added
+        """
+        total_number_of_blocks_added = 0
+        uncommitted = 0
+        failed = False
+        reorganized = False
+        orphaned = False
+        old_diff_length = self.db.get('diffLength')
+
+        self.db.simulate()
+        try:
+            length = self.db.get('length')
+            fork_length = self.find_fork(blocks)
+            if fork_length is not None and fork_length < length:
+                # Unwind our chain back to the common block. Everything happens in the same simulation,
+                # so a failed replay leaves our chain untouched.
+                max_depth = self.engine.config.get('blockchain', {}).get('max_reorg_depth', 1000)
+                if length - fork_length > max_depth:
+                    tools.log('Ignoring fork at {} that is deeper than {} blocks'.format(fork_length, max_depth))
+                    self.db.rollback()
+                    return 0
+                state_base = self.db.get('state_base')
+                if state_base is not None and fork_length < state_base:
+                    # Chain started from a state file. There is nothing to unwind to below it.
+                    tools.log('Ignoring fork at {} below loaded state at {}'.format(fork_length, state_base))
+                    self.db.rollback()
+                    return 0
+                while self.db.get('length') > fork_length:
+                    self.delete_block()
+                reorganized = True
+
+            while blocks is not None and not failed:
+                for i, block in enumerate(blocks):
+                    add_block_result = 2 if orphaned else self.add_block(block, verified=True)
+                    if add_block_result == 2:
+                        # Blocks ahead of us cannot be added yet. Keep them until their parent arrives.
+                        self.orphans.add(blocks[i:], node_id)
+                        orphaned = True
+                        break
+                    elif add_block_result == 3:
+                        failed = True
+                        break
+                    elif add_block_result == 0:
+                        total_number_of_blocks_added += 1
+                        uncommitted += 1
+                        api.new_block()
+                if not failed and uncommitted > 0 and \
+                        (not reorganized or int(self.db.get('diffLength') or '0', 16) > int(old_diff_length or '0', 16)):
+                    # Our chain now ends with these blocks. Later batches simply extend it.
+                    self.db.commit()
+                    self.db.simulate()
+                    uncommitted = 0
+                    reorganized = False
+                blocks = next_batch() if next_batch is not None and not failed else None
+        except Exception as e:
+            tools.log(e)
+            failed = True
+
+        # Whatever is left uncommitted is a fork that is not heavier than our chain or a failed batch.
+        self.db.rollback()
+        total_number_of_blocks_added -= uncommitted
+        if failed:
+            # Received blocks failed. Punish the peer by lowering rank.
+            if node_id != 'miner':
+                self.peer_reported_false_blocks(node_id)
+        if total_number_of_blocks_added > 0:
+            if node_id != 'miner':
+                self.clientdb.update_peer_metrics(node_id, useful_blocks=total_number_of_blocks_added)
+            if total_number_of_blocks_added == 1 and not failed:
+                # A single new block on top of our chain. Relay it to peers as a compact block.
+                self.engine.peers_check.relay_block(self.get_block(self.db.get('length')), node_id)
+        return total_number_of_blocks_added
+
     @sync
     def set_chain_state(self, new_state):
         self.__state = new_state
@@ -128,6 +282,14 @@ class BlockchainService(Service):
         """
         return self.mempool
 
+    def tx_pool_view(self):
+        """
+        Copy of the pool taken without waiting for kvstore lock.
+        Appending to pool and swapping it in tx_pool_pop_all are atomic, so the copy is always a valid list.
+        :return:
+        """
+        return list(self.mempool)
+
     @lockit('kvstore')
     def tx_pool_add(self, tx):
         """
@@ -136,8 +298,28 @@ class BlockchainService(Service):
         :return: None
         """
         self.mempool.append(tx)
+        self.mempool_index[tools.tx_hash(tx)] = tx
         api.new_tx_in_pool()
 
+    @lockit('kvstore')
+    def tx_pool_hashes(self):
+        """
+        :return: Short hashes of the transactions waiting in the pool
+        """
+        return list(self.mempool_index.keys())
+
+    @lockit('kvstore')
+    def tx_pool_get(self, hashes):
+        """
+        :param hashes: Short tx hashes
+        :return: Transactions in the pool that match given hashes
+        """
+        return [self.mempool_index[_hash] for _hash in hashes if _hash in self.mempool_index]
+
+    @lockit('kvstore')
+    def tx_pool_has(self, tx_hash):
+        return tx_hash in self.mempool_index
+
     @lockit('kvstore')
     def tx_pool_pop_all(self):
         #TODO: empty the pool
@@ -147,22 +329,17 @@ class BlockchainService(Service):
         """
         mempool = copy.deepcopy(self.mempool)
         self.mempool = []
+        self.mempool_index = {}
         return mempool
 
     def peer_reported_false_blocks(self, node_id):
-        peer = self.clientdb.get_peer(node_id)
-        if peer is not None:
-            peer['rank'] *= 0.8
-            peer['rank'] += 0.2 * 30
-            self.clientdb.update_peer(peer)
+        self.clientdb.report_false_blocks(node_id)
 
     def add_tx(self, tx):
         if not isinstance(tx, dict):
             return Response(False, 'Transactions must be dict typed')
 
-        txs_in_pool = self.tx_pool()
-
-        if tx in txs_in_pool:
+        if self.tx_pool_has(tools.tx_hash(tx)):
             return Response(False, 'no duplicates')
         if 'type' not in tx or tx['type'] not in BlockchainService.tx_types or tx['type'] == 'mint':
             return Response(False, 'Invalid type')
@@ -179,10 +356,11 @@ class BlockchainService(Service):
         self.tx_pool_add(tx)
         return Response(True, 'Added tx into the pool: ' + str(tx))
 
-    def add_block(self, block):
+    def add_block(self, block, verified=False):
         """Attempts adding a new block to the blockchain.
          Median is good for weeding out liars, so long as the liars don't have 51%
-         hashpower. """
+         hashpower.
+         If verified is set, block already passed block_stateless_check in the verification stage. """
 
         length = self.db.get('length')
         block_at_length = self.get_block(length)
@@ -203,13 +381,11 @@ class BlockchainService(Service):
             tools.log('difflength is wrong')
             return 3
 
-        if length >= 0 and tools.det_hash(block_at_length) != block['prevHash']:
+        if length >= 0 and self.get_block_hash(length) != block['prevHash']:
             tools.log('prevhash different')
             return 3
 
-        nonce_and_hash = tools.hash_without_nonce(block)
-        if tools.det_hash(nonce_and_hash) > block['target']:
-            tools.log('hash value does not match the target')
+        if not verified and not BlockchainService.block_stateless_check(block):
             return 3
 
         if block['target'] != self.target(block['length']):
@@ -226,23 +402,11 @@ class BlockchainService(Service):
             return 3
         """
 
-        # Check that block includes exactly one mint transaction
-        if 'txs' not in block:
-            tools.log('Received block does not include txs. At least a coinbase tx must be present')
-            return 3
-
-        # Sum of all mint type transactions must be one
-        mint_present = sum([0 if tx['type'] != 'mint' else 1 for tx in block['txs']])
-        if mint_present != 1:
-            tools.log('Received block includes wrong amount of mint txs')
+        if not self.statedb.update_database_with_block(block):
             return 3
 
-        for tx in block['txs']:
-            if not BlockchainService.tx_integrity_check(tx).getFlag():
-                tools.log('Received block failed special txs check.')
-                return 3
-
-        if not self.statedb.update_database_with_block(block):
+        if 'stateRoot' in block and self.statedb.tree.root() != block['stateRoot']:
+            tools.log('state root is wrong')
             return 3
 
         self.put_block(block['length'], block)
@@ -271,6 +435,7 @@ class BlockchainService(Service):
             orphans.append(tx)
 
         self.del_block(length)
+        api.removed_block(length)
         length -= 1
 
         self.db.put('length', length)
@@ -287,18 +452,136 @@ class BlockchainService(Service):
 
     @lockit('kvstore')
     def get_block(self, length):
-        length = str(length).zfill(12)
-        return self.db.get('block_' + length)
+        return self.db.get(BlockchainService.block_key(length))
+
+    @staticmethod
+    def block_key(length):
+        return 'block_' + str(length).zfill(12)
+
+    @staticmethod
+    def block_hash_key(length):
+        return 'blockhash_' + str(length).zfill(12)
+
+    @lockit('kvstore')
+    def get_block_hash(self, length):
+        """
+        Hashes are stored next to blocks so that they are not computed over and over again.
+        :param length: Block length
+        :return: Hash of the block or None
+        """
+        block_hash = self.db.get(BlockchainService.block_hash_key(length))
+        if block_hash is None:
+            block = self.get_block(length)
+            if block is not None:
+                block_hash = tools.block_hash(block)
+        return block_hash
 
     @lockit('kvstore')
     def put_block(self, length, block):
-        length = str(length).zfill(12)
-        return self.db.put('block_' + length, block)
+        self.db.put(BlockchainService.block_hash_key(length), tools.block_hash(block))
+        return self.db.put(BlockchainService.block_key(length), block)
 
     @lockit('kvstore')
     def del_block(self, length):
-        length = str(length).zfill(12)
-        return self.db.delete('block_' + length)
+        self.db.delete(BlockchainService.block_hash_key(length))
+        return self.db.delete(BlockchainService.block_key(length))
+
+    @staticmethod
+    def make_compact_block(block, prefill=()):
+        """
+        Compact representation of a block for relaying. Txs are replaced by their short hashes
+        except mint txs and the ones at given indexes, which are sent in full.
+        :param block: Full block
+        :param prefill: Indexes of txs that must be sent in full
+        :return: compact block dict
+        """
+        header = {key: value for key, value in block.items() if key != 'txs'}
+        return {
+            'header': header,
+            'hash': tools.block_hash(block).hex(),
+            'tx_ids': [tools.tx_hash(tx) for tx in block['txs']],
+            'prefilled': [[i, tx] for i, tx in enumerate(block['txs']) if tx['type'] == 'mint' or i in prefill]
+        }
+
+    def rebuild_compact_block(self, compact):
+        """
+        Rebuild a full block from a compact block by using txs in our mempool.
+        :param compact: compact block dict
+        :return: (block, missing indexes). Block is None if some txs are missing.
+        """
+        txs = [None] * len(compact['tx_ids'])
+        for i, tx in compact['prefilled']:
+            txs[i] = tx
+        for i, tx_id in enumerate(compact['tx_ids']):
+            if txs[i] is None:
+                found = self.tx_pool_get([tx_id])
+                if len(found) > 0:
+                    txs[i] = found[0]
+        missing = [i for i, tx in enumerate(txs) if tx is None]
+        if len(missing) > 0:
+            return None, missing
+        block = copy.deepcopy(compact['header'])
+        block['txs'] = txs
+        # Block hash covers txs only through txRoot, so txs are checked against it as well.
+        if tools.block_hash(block).hex() != compact['hash'] or \
+                ('txRoot' in block and tools.tx_merkle_root(txs) != block['txRoot']):
+            # Short hash collision. Ask for every tx that was taken from mempool.
+            prefilled = set(i for i, tx in compact['prefilled'])
+            return None, [i for i in range(len(txs)) if i not in prefilled]
+        return block, []
+
+    @staticmethod
+    def has_only_block_fields(block):
+        """
+        :return: Whether every key of a block is a header field, nonce or txs
+        """
+        return all(key in tools.header_fields or key in ('nonce', 'txs') for key in block.keys())
+
+    @staticmethod
+    def block_stateless_check(block, check_signatures=True):
+        """
+        Checks that do not depend on chain state: proof of work against the claimed target,
+        presence of exactly one mint tx and integrity of every tx including signatures.
+        These are run in the verification stage, concurrently with state updates of earlier blocks.
+        :param block: Block to check
+        :param check_signatures: Verify tx signatures. Only skipped for blocks that are trusted already.
+        :return: Whether block passed
+        """
+        nonce_and_hash = tools.hash_without_nonce(block)
+        if tools.det_hash(nonce_and_hash) > block['target']:
+            tools.log('hash value does not match the target')
+            return False
+
+        # Check that block includes exactly one mint transaction
+        if 'txs' not in block:
+            tools.log('Received block does not include txs. At least a coinbase tx must be present')
+            return False
+
+        # Sum of all mint type transactions must be one
+        mint_present = sum([0 if tx['type'] != 'mint' else 1 for tx in block['txs']])
+        if mint_present != 1:
+            tools.log('Received block includes wrong amount of mint txs')
+            return False
+
+        if 'txRoot' not in block and block['length'] >= custom.header_roots_from:
+            tools.log('Received block does not commit to its txs and state')
+            return False
+
+        # Proof of work covers only the header. Header must commit to exactly these txs.
+        if 'txRoot' in block and ('stateRoot' not in block or tools.tx_merkle_root(block['txs']) != block['txRoot']):
+            tools.log('Received block has a wrong tx root')
+            return False
+
+        # Keys outside the header are not covered by block hash. Relays must not be able to add any.
+        if 'txRoot' in block and not BlockchainService.has_only_block_fields(block):
+            tools.log('Received block has fields that are not part of its header')
+            return False
+
+        for tx in block['txs']:
+            if not BlockchainService.tx_integrity_check(tx, check_signature=check_signatures).getFlag():
+                tools.log('Received block failed special txs check.')
+                return False
+        return True
 
     @staticmethod
     def block_integrity_check(block):
@@ -369,29 +652,65 @@ class BlockchainService(Service):
             return False
         return True
 
-    def fork_check(self, newblocks, length, top_block_on_chain):
+    def find_fork(self, newblocks):
         """
-        Check whether a fork happens while adding these blocks.
-        If a fork is detected, return the index of last matched block.
-        :param newblocks: Received blocks.
-        :param length:
-        :param top_block_on_chain:
-        :return:
+        Find where received blocks leave our chain.
+        Blocks are compared against stored hashes until the first one that we do not have.
+        :param newblocks: Consecutive received blocks
+        :return: Length of the last common block, -1 if chains differ from genesis,
+        None if received blocks cannot be connected to our chain.
+        """
+        length = self.db.get('length')
+        for i, block in enumerate(newblocks):
+            if block['length'] > length:
+                return block['length'] - 1 if i > 0 else None
+            if self.get_block_hash(block['length']) != tools.block_hash(block):
+                if i > 0 or block['length'] == 0:
+                    return block['length'] - 1
+                return None
+        return length
+
+    def block_locator(self):
+        """
+        Hashes of our chain, dense near the top and exponentially sparse towards genesis.
+        A peer finds our common block by looking for the first hash it also has.
+        :return: List of [length, hash hex] in descending length order
         """
-        recent_hash = tools.det_hash(top_block_on_chain)
-        their_hashes = list(map(lambda x: x['prevHash'] if x['length'] > 0 else 0, newblocks))
-        their_hashes += [tools.det_hash(newblocks[-1])]
-        a = (recent_hash not in their_hashes)
-        b = newblocks[0]['length'] - 1 < length < newblocks[-1]['length']
-        c = tools.det_hash(newblocks[0]) == tools.det_hash(self.get_block(newblocks[0]['length']))
-        return a and b and c
+        locator = []
+        length = self.db.get('length')
+        step = 1
+        while length >= 0:
+            block_hash = self.get_block_hash(length)
+            if block_hash is not None:
+                locator.append([length, block_hash.hex()])
+            if len(locator) >= 10:
+                step *= 2
+            length -= step
+        if len(locator) == 0 or locator[-1][0] != 0:
+            block_hash = self.get_block_hash(0)
+            if block_hash is not None:
+                locator.append([0, block_hash.hex()])
+        return locator
+
+    def locate(self, locator):
+        """
+        Find the highest block in a peer's locator that is also on our chain.
+        :param locator: Output of block_locator from a peer
+        :return: Length of the common block or -1
+        """
+        for length, block_hash in locator:
+            our_hash = self.get_block_hash(length)
+            if our_hash is not None and our_hash.hex() == block_hash:
+                return length
+        return -1
 
     @staticmethod
-    def tx_integrity_check(tx):
+    def tx_integrity_check(tx, check_signature=True):
         """
         This functions test whether a transaction has basic things right.
         Does it have amount, recipient, RIGHT SIGNATURES and correct address types.
         :param tx:
+        :param check_signature: Whether signatures are verified
         :return:
         """
         if not isinstance(tx, dict):
@@ -403,7 +722,7 @@ class BlockchainService(Service):
         if tx['type'] == 'spend':
             if 'to' not in tx or not isinstance(tx['to'], str):
                 return Response(False, 'Reward or spend transactions must be addressed')
-            if not BlockchainService.tx_signature_check(tx):
+            if check_signature and not BlockchainService.tx_signature_check(tx):
                 return Response(False, 'Transaction is not properly signed')
             if not tools.is_address_valid(tx['to']):
                 return Response(False, 'Address is not valid')
@@ -416,19 +735,20 @@ class BlockchainService(Service):
 
         return Response(True, 'Everything seems fine')
 
-    def recent_block_attributes(self, key, size):
-        length = self.db.get('length')
-        start = max((length - size), 0)
-        result = []
-        for i in range(start, length):
-            result.append(self.get_block(i)[key[:-1]])
-        # start_key = ('block_' + str(start).zfill(12)).encode()
-        # stop_key = ('block_' + str(length).zfill(12)).encode()
-        # blocks = list(self.db.iterator(start=start_key, stop=stop_key, include_stop=False))
-        return result
-
     @lockit('kvstore')
     def target(self, length):
+        """ Returns the target difficulty at a particular blocklength. """
+        return BlockchainService.target_from(length, self.get_block)
+
+    @staticmethod
+    def target_from(length, get_block):
+        """
+        Target difficulty at a length, computed from the targets and times of blocks before it.
+        Only header fields are read, so light nodes apply the same rule to headers.
+        :param length: Length of the block whose target is computed
+        :param get_block: Function that gives the block or header at a smaller length
+        :return: Target
+        """
         def targetTimesFloat(target, number):
             a = int(str(target), 16)
             b = int(a * number)  # this should be rational multiplication followed by integer estimation
@@ -440,6 +760,11 @@ class BlockchainService(Service):
             out.reverse()
             return out
 
+        def recent_block_attributes(key, size):
+            # Block right before length is left out, as it always has been.
+            start = max(length - 1 - size, 0)
+            return [get_block(i)[key] for i in range(start, length - 1)]
+
         def estimate_target():
             """
             We are actually interested in the average number of hashes required to
@@ -454,7 +779,7 @@ class BlockchainService(Service):
                     l = [tools.hex_sum(l[0], l[1])] + l[2:]
                 return l[0]
 
-            targets = self.recent_block_attributes('targets', custom.history_length)
+            targets = recent_block_attributes('target', custom.history_length)
             w = weights(len(targets))  # should be rat instead of float
             tw = sum(w)
             targets = list(map(tools.hex_invert, targets))
@@ -463,7 +788,7 @@ class BlockchainService(Service):
             return tools.hex_invert(sumTargets(weighted_targets))
 
         def estimate_time():
-            times = self.recent_block_attributes('times', custom.history_length)
+            times = recent_block_attributes('time', custom.history_length)
             times = list(map(Decimal, times))
             # How long it took to generate blocks
             block_times = [times[i] - times[i - 1] for i in range(1, len(times))]
@@ -471,7 +796,6 @@ class BlockchainService(Service):
             tw = sum(w)
             return sum([w[i] * block_times[i] / tw for i in range(len(block_times))])
 
-        """ Returns the target difficulty at a particular blocklength. """
         if length < 100:
             return bytearray.fromhex(custom.first_target)  # Use same difficulty for first few blocks.
         if length == 100 or length % custom.recalculate_target_at == 0:
@@ -479,7 +803,7 @@ class BlockchainService(Service):
             result = targetTimesFloat(estimate_target(), retarget)
             return bytearray.fromhex(result)
         elif 100 < length < custom.recalculate_target_at:
-            return self.get_block(100)['target']
+            return get_block(100)['target']
         else:
             last_block = length - (length % custom.recalculate_target_at)
-            return self.get_block(last_block)['target']
+            return get_block(last_block)['target']
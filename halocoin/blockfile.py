@@ -0,0 +1,56 @@
+import io
+import pickle
+import struct
+
+# Binary block files start with this header. Every block follows as a record:
+# 8 bytes length, 4 bytes size of payload, payload. Payload is the block pickled
+# exactly as it is stored in database, so exporting does not decode anything.
+MAGIC = b'HALOCOIN-BLOCKS-1\n'
+RECORD_HEADER = struct.Struct('>QI')
+
+
+class SafeUnpickler(pickle.Unpickler):
+    """
+    Blocks consist of dicts, lists, strings, bytes, bytearrays and numbers only. Bytearray targets
+    are the only values that need a global lookup, so refusing every other global keeps a crafted
+    file from running code.
+    """
+    allowed_globals = {('builtins', 'bytearray')}
+
+    def find_class(self, module, name):
+        if (module, name) in SafeUnpickler.allowed_globals:
+            return pickle.Unpickler.find_class(self, module, name)
+        raise pickle.UnpicklingError('Block files cannot refer to {}.{}'.format(module, name))
+
+
+def encode_record(length, payload):
+    """
+    :param length: Block length
+    :param payload: Pickled block
+    :return: Record bytes
+    """
+    return RECORD_HEADER.pack(length, len(payload)) + payload
+
+
+def read_blocks(f):
+    """
+    Read blocks from a binary block file one by one.
+    :param f: File object opened in binary mode
+    :return: Generator of blocks
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a halocoin block file')
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) == 0:
+            return
+        if len(header) < RECORD_HEADER.size:
+            raise ValueError('Block file is truncated')
+        length, size = RECORD_HEADER.unpack(header)
+        payload = f.read(size)
+        if len(payload) < size:
+            raise ValueError('Block file is truncated')
+        block = SafeUnpickler(io.BytesIO(payload)).load()
+        if not isinstance(block, dict) or block.get('length', None) != length:
+            raise ValueError('Record at {} does not hold the block it claims'.format(length))
+        yield block
@@ -29,13 +29,20 @@ connection_port = 7899
 host = os.environ.get('HALOCOIN_API_HOST', 'localhost')
 
 
-def action(func):
+def action(func=None, name=None):
+    """
+    Register a CLI action. Action is named after the function unless a name is given,
+    e.g. @action(name='import') for names that cannot be function names.
+    """
+    if func is None:
+        return lambda f: action(f, name=name)
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         return func(*args, **kwargs)
 
     global actions
-    actions[func.__name__] = wrapper
+    actions[name if name is not None else func.__name__] = wrapper
     return wrapper
 
 
@@ -100,12 +107,33 @@ def extract_configuration(dir, config):
 
 
 @action
-def start(dir=None, config=None):
+def start(dir=None, config=None, snapshot=None, light=False):
     config, working_dir = extract_configuration(dir, config)
     tools.init_logging(config['DEBUG'], working_dir, config['logging']['file'])
+    if light:
+        config.setdefault('light', {})['enabled'] = True
+    if snapshot is not None and config.get('light', {}).get('enabled', False):
+        sys.stderr.write("Light mode keeps only headers, it cannot start from a state file\n")
+        sys.exit(1)
+    if snapshot is not None and not engine.load_state(config, working_dir, snapshot):
+        sys.exit(1)
     engine.main(config, working_dir)
 
 
+@action
+def snapshot(file, end=None, dir=None, config=None):
+    config, working_dir = extract_configuration(dir, config)
+    tools.init_logging(config['DEBUG'], working_dir, config['logging']['file'])
+    engine.dump_state(config, working_dir, file, end)
+
+
+@action(name='import')
+def import_blocks(file, dir=None, config=None, trusted_height=None):
+    config, working_dir = extract_configuration(dir, config)
+    tools.init_logging(config['DEBUG'], working_dir, config['logging']['file'])
+    engine.import_blocks(config, working_dir, file, trusted_height)
+
+
 @action
 def new_wallet(wallet, pw):
     from getpass import getpass
@@ -161,6 +189,22 @@ def blocks(start, end=None):
     pprint(_blocks)
 
 
+@action
+def export(file, start=None, end=None, format=None):
+    url = "http://" + str(host) + ":" + str(connection_port) + "/export_blocks"
+    data = {k: v for k, v in dict(start=start, end=end, format=format).items() if v is not None}
+    response = requests.post(url, data=data, stream=True)
+    if response.status_code != 200 or response.headers.get('Content-Type', '').startswith('application/json'):
+        print(response.text)
+        return
+    size = 0
+    with open(file, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            f.write(chunk)
+            size += len(chunk)
+    print('Exported blocks into {} ({} bytes)'.format(file, size))
+
+
 @action
 def blockcount():
     result = make_api_request("blockcount")
@@ -174,6 +218,11 @@ def balance(address=None):
     print(make_api_request("balance", address=address))
 
 
+@action
+def balances(address):
+    pprint(make_api_request("balances", addresses=address))
+
+
 @action
 def node_id():
     print(make_api_request("node_id"))
@@ -199,8 +248,8 @@ def peers():
 
 
 @action
-def history(address):
-    history = make_api_request("history", address=address)
+def history(address, cursor=None, limit=None, direction=None):
+    history = make_api_request("history", address=address, cursor=cursor, limit=limit, direction=direction)
     pprint(history)
 
 
@@ -254,8 +303,20 @@ def run(argv):
                         help='Starting number while requesting range of blocks')
     parser.add_argument('--end', metavar='<integer>', action="store", type=str, dest='end',
                         help='Ending number while requesting range of blocks')
+    parser.add_argument('--cursor', action="store", type=str, dest='cursor',
+                        help='Continue a paged listing from the cursor returned by previous page')
+    parser.add_argument('--limit', metavar='<integer>', action="store", type=int, dest='limit',
+                        help='Maximum number of items to list')
+    parser.add_argument('--direction', action="store", type=str, dest='direction', choices=['send', 'recv'],
+                        help='Only list sent or received transactions')
     parser.add_argument('--file', metavar='/file/path', action="store", type=str, dest='file',
-                        help='File path for wallet upload')
+                        help='File path for wallet upload, block export or import')
+    parser.add_argument('--format', action="store", type=str, dest='format', choices=['ndjson', 'binary'],
+                        help='Format of exported blocks')
+    parser.add_argument('--snapshot', metavar='/file/path', action="store", type=str, dest='snapshot',
+                        help='State file to start an empty node from. Use with start command.')
+    parser.add_argument('--trusted-height', metavar='<integer>', action="store", type=int, dest='trusted_height',
+                        help='Do not verify signatures of imported blocks below this length')
     parser.add_argument('--wallet', metavar='my_wallet', action="store", type=str, dest='wallet',
                         help='Wallet name')
     parser.add_argument('--config', action="store", type=str, dest='config',
@@ -268,6 +329,8 @@ def run(argv):
                         help='Override API port defined in config file.')
     parser.add_argument('--force', action="store_true", dest='force',
                         help='Force something that makes trouble.')
+    parser.add_argument('--light', action="store_true", dest='light',
+                        help='Sync only headers and verify watched addresses with proofs. Use with start command.')
 
     args = parser.parse_args(argv[1:])
 
@@ -1,6 +1,10 @@
+import copy
 import os
 import pickle
+import random
+import struct
 import sys
+import time
 
 import plyvel
 
@@ -24,14 +28,47 @@ class ClientDB:
         'length': -1
     }
 
+    default_peer_history = {
+        "greetings": 0,
+        "peer_transfer": 0,
+        "bytes_raw": 0,
+        "bytes_wire": 0,
+        "added": 0,
+        "tries": 0,
+        "false_blocks": 0,
+        "rtt": 1.0,
+        "throughput": 0.0,
+        "success_rate": 1.0,
+        "useful_blocks": 0.0,
+        "penalty": 0.0
+    }
+
     def __init__(self, engine):
         self.engine = engine
         self.DB = None
         self.blockchain = None
+        # In-memory peer table. Changes are written behind to database by flush_peers.
+        # Table is guarded by 'peers' lock, histories by 'peer_histories' and bans by 'peer_bans'.
+        # A thread that needs more than one takes them in that order.
+        self.peers = {}
+        self.peer_addresses = {}
+        self.peer_histories = {}
+        self.stored_peers = {}
+        self.dirty_peers = set()
+        self.removed_peers = {}
+        self.dirty_histories = set()
+        self.removed_histories = set()
+        self.bans = {}
+        self.dirty_bans = False
+        # False block reports against inbound hosts, by IP address.
+        self.ip_false_blocks = {}
         try:
             db_location = os.path.join(self.engine.working_dir, 'client.db')
             DB = plyvel.DB(db_location, create_if_missing=True)
             self.DB = DB.prefixed_db(custom.version.encode())
+            self.migrate_peer_list()
+            self.load_peers()
+            self.bans = self.get('peer_bans') or {}
         except Exception as e:
             tools.log(e)
             sys.stderr.write('Database connection cannot be established!\n')
@@ -56,21 +93,443 @@ class ClientDB:
         except:
             return False
 
+    def close(self):
+        self.DB.db.close()
+
+    @staticmethod
+    def rank_key(rank, node_id):
+        """
+        Key of a peer in rank index. Float rank is encoded so that byte order of keys
+        matches numeric order of ranks.
+        """
+        bits = struct.unpack('>Q', struct.pack('>d', float(rank)))[0]
+        if bits >> 63:
+            bits ^= 0xFFFFFFFFFFFFFFFF
+        else:
+            bits |= 1 << 63
+        return 'peerrank_{:016x}_{}'.format(bits, node_id)
+
+    @staticmethod
+    def address_key(ip, port):
+        return 'peeraddr_{}:{}'.format(ip, port)
+
+    def migrate_peer_list(self):
+        """
+        Earlier versions kept every peer in a single pickled list. Move them to per-peer records.
+        :return: None
+        """
+        peers = self.get('peer_list')
+        if peers is None:
+            return
+        for peer in peers:
+            if self.get('peer_' + peer['node_id']) is None:
+                self.write_peer(peer)
+        self.delete('peer_list')
+
+    def load_peers(self):
+        """
+        Fill in-memory peer table from per-peer records in database.
+        :return: None
+        """
+        for key, value in self.DB.iterator(prefix=b'peerrank_'):
+            peer = self.get('peer_' + pickle.loads(value))
+            if peer is not None:
+                self.peers[peer['node_id']] = peer
+                self.peer_addresses[(peer['ip'], peer['port'])] = peer['node_id']
+                self.stored_peers[peer['node_id']] = copy.deepcopy(peer)
+
+    def write_peer(self, peer, old_peer=None, wb=None):
+        """
+        Write a peer record and its index entries.
+        :param peer: New peer dict
+        :param old_peer: Earlier version of the same peer, if any. Its index entries are removed.
+        :param wb: Write batch to use. A new batch is created if not given.
+        :return: None
+        """
+        if wb is None:
+            with self.DB.write_batch() as wb:
+                return self.write_peer(peer, old_peer, wb)
+        if old_peer is not None:
+            wb.delete(ClientDB.rank_key(old_peer['rank'], old_peer['node_id']).encode())
+            if (old_peer['ip'], old_peer['port']) != (peer['ip'], peer['port']):
+                wb.delete(ClientDB.address_key(old_peer['ip'], old_peer['port']).encode())
+        wb.put(('peer_' + peer['node_id']).encode(), pickle.dumps(peer))
+        wb.put(ClientDB.rank_key(peer['rank'], peer['node_id']).encode(), pickle.dumps(peer['node_id']))
+        wb.put(ClientDB.address_key(peer['ip'], peer['port']).encode(), pickle.dumps(peer['node_id']))
+
+    @staticmethod
+    def erase_peer(peer, wb):
+        wb.delete(('peer_' + peer['node_id']).encode())
+        wb.delete(ClientDB.rank_key(peer['rank'], peer['node_id']).encode())
+        wb.delete(ClientDB.address_key(peer['ip'], peer['port']).encode())
+
+    @lockit('peers_flush')
+    def flush_peers(self):
+        """
+        Write changed peers and peer histories to database in a single batch.
+        Called periodically by peer check service and at shutdown.
+        :return: Number of written records
+        """
+        dirty_peers, removed_peers, dirty_histories, removed_histories, bans = self.pop_peer_changes()
+        with self.DB.write_batch() as wb:
+            for node_id in removed_histories:
+                wb.delete(('peer_history_' + node_id).encode())
+            if bans is not None:
+                wb.put(b'peer_bans', pickle.dumps(bans))
+            for node_id, peer in removed_peers.items():
+                ClientDB.erase_peer(peer, wb)
+            for node_id, (peer, old_peer) in dirty_peers.items():
+                self.write_peer(peer, old_peer, wb)
+            for node_id, peer_history in dirty_histories.items():
+                wb.put(('peer_history_' + node_id).encode(), pickle.dumps(peer_history))
+        return len(removed_peers) + len(dirty_peers) + len(dirty_histories) + len(removed_histories)
+
+    @lockit('peers')
+    def pop_peer_changes(self):
+        """
+        Take copies of changed records and mark the table as clean.
+        Stored versions are updated right away, so a peer that is removed before the batch is written
+        is erased by the next flush.
+        :return: (changed peers with their stored versions, removed peers, changed histories,
+        removed histories, bans if changed)
+        """
+        dirty_peers = {}
+        for node_id in self.dirty_peers:
+            if node_id in self.peers:
+                peer = copy.deepcopy(self.peers[node_id])
+                dirty_peers[node_id] = (peer, self.stored_peers.get(node_id, None))
+                self.stored_peers[node_id] = peer
+        removed_peers = self.removed_peers
+        for node_id in removed_peers.keys():
+            self.stored_peers.pop(node_id, None)
+        self.dirty_peers = set()
+        self.removed_peers = {}
+        dirty_histories, removed_histories = self.pop_history_changes()
+        return dirty_peers, removed_peers, dirty_histories, removed_histories, self.pop_ban_changes()
+
+    @lockit('peer_histories')
+    def pop_history_changes(self):
+        dirty_histories = {node_id: copy.deepcopy(self.peer_histories[node_id])
+                           for node_id in self.dirty_histories if node_id in self.peer_histories}
+        removed_histories = self.removed_histories
+        self.dirty_histories = set()
+        self.removed_histories = set()
+        return dirty_histories, removed_histories
+
+    @lockit('peer_bans')
+    def pop_ban_changes(self):
+        bans = copy.deepcopy(self.bans) if self.dirty_bans else None
+        self.dirty_bans = False
+        return bans
+
+    def _set_peer(self, peer):
+        old_peer = self.peers.get(peer['node_id'], None)
+        if old_peer is not None and (old_peer['ip'], old_peer['port']) != (peer['ip'], peer['port']):
+            self.peer_addresses.pop((old_peer['ip'], old_peer['port']), None)
+        self.peers[peer['node_id']] = peer
+        self.peer_addresses[(peer['ip'], peer['port'])] = peer['node_id']
+        self.dirty_peers.add(peer['node_id'])
+        self.removed_peers.pop(peer['node_id'], None)
+
+    def _remove_peer(self, node_id):
+        peer = self.peers.pop(node_id, None)
+        if peer is None:
+            return
+        self.peer_addresses.pop((peer['ip'], peer['port']), None)
+        self.dirty_peers.discard(node_id)
+        if node_id in self.stored_peers:
+            self.removed_peers[node_id] = self.stored_peers[node_id]
+        self._drop_history(node_id)
+
+    @lockit('peer_histories')
+    def _drop_history(self, node_id):
+        self.peer_histories.pop(node_id, None)
+        self.dirty_histories.discard(node_id)
+        self.removed_histories.add(node_id)
+
+    @staticmethod
+    def subnet(ip):
+        """
+        :return: /16 subnet of an IPv4 address. Other addresses are their own bucket.
+        """
+        parts = str(ip).split('.')
+        if len(parts) == 4:
+            return '.'.join(parts[:2])
+        return str(ip)
+
+    def _worst_peer(self, peers):
+        """
+        :return: Node id of the peer with the highest rank among given peers
+        """
+        if len(peers) == 0:
+            return None
+        return max(peers, key=lambda p: p['rank'])['node_id']
+
+    def _make_room(self, peer, force):
+        """
+        Address book is bounded in total size and in number of peers per /16 subnet.
+        If there is no room for the peer, the worst ranked peer in the way is evicted
+        when force is set. Otherwise the new peer is refused.
+        :param peer: Peer to be added
+        :param force: Whether existing peers can be evicted for this one
+        :return: Whether there is room for the peer
+        """
+        peers_config = self.engine.config['peers']
+        max_per_subnet = peers_config.get('max_peers_per_subnet', 8)
+        max_peers = peers_config.get('max_peers', 256)
+
+        same_subnet = [p for p in self.peers.values() if ClientDB.subnet(p['ip']) == ClientDB.subnet(peer['ip'])]
+        if len(same_subnet) >= max_per_subnet:
+            if not force:
+                return False
+            self._remove_peer(self._worst_peer(same_subnet))
+        if len(self.peers) >= max_peers:
+            if not force:
+                return False
+            self._remove_peer(self._worst_peer(list(self.peers.values())))
+        return True
+
+    @lockit('peers')
+    def evict_stale_peers(self):
+        """
+        Drop peers that we could not greet in last 24 hours and in last 50 tries. Both must hold.
+        Also clear expired bans.
+        :return: Number of evicted peers
+        """
+        peers_config = self.engine.config['peers']
+        stale_time = peers_config.get('stale_time', 24 * 60 * 60)
+        stale_tries = peers_config.get('stale_tries', 50)
+        now = time.time()
+        stale = []
+        for node_id in self.peers.keys():
+            peer_history = self.get_peer_history(node_id)
+            last_seen = max(peer_history['greetings'], peer_history['added'])
+            if now - last_seen > stale_time and peer_history['tries'] >= stale_tries:
+                stale.append(node_id)
+        for node_id in stale:
+            self._remove_peer(node_id)
+
+        self.ip_false_blocks = {}
+        self._expire_bans(now)
+        return len(stale)
+
+    @lockit('peer_bans')
+    def _expire_bans(self, now):
+        expired = [key for key, until in self.bans.items() if until < now]
+        for key in expired:
+            del self.bans[key]
+        if len(expired) > 0:
+            self.dirty_bans = True
+
+    @lockit('peers')
+    def record_contact(self, node_id, success, rtt=None):
+        """
+        Note the result of an attempt to greet a peer.
+        :param node_id: Node id of the peer
+        :param success: Whether peer answered our greeting
+        :param rtt: Round trip time of the greeting in seconds
+        :return: None
+        """
+        if node_id not in self.peers:
+            return
+        peer_history = self.get_peer_history(node_id)
+        if success:
+            peer_history['greetings'] = time.time()
+            peer_history['tries'] = 0
+        else:
+            peer_history['tries'] += 1
+        self.set_peer_history(node_id, peer_history)
+        self.update_peer_metrics(node_id, success=success, rtt=rtt if success else None)
+
+    @staticmethod
+    def ewma(old, new, alpha):
+        return (1 - alpha) * old + alpha * new
+
+    @staticmethod
+    def peer_score(peer_history):
+        """
+        Score of a peer out of its measured metrics. Lower is better, like rank.
+        Round trip time is the base. It is divided by success rate, throughput on range
+        downloads and number of useful blocks the peer supplied. Penalties for false
+        blocks and abuse are added on top.
+        :param peer_history: Peer history dict
+        :return: score
+        """
+        score = peer_history['rtt'] / max(peer_history['success_rate'], 0.05)
+        score /= 1 + peer_history['throughput'] / (1024 * 1024)
+        score /= 1 + peer_history['useful_blocks']
+        return score + peer_history['penalty']
+
+    @lockit('peers')
+    def update_peer_metrics(self, node_id, rtt=None, throughput=None, success=None, useful_blocks=None,
+                            penalty=None):
+        """
+        Update exponentially weighted moving averages of a peer's metrics and recompute its rank.
+        Penalty is accumulated instead of averaged and it decays at every successful contact.
+        :param node_id: Node id of the peer
+        :param rtt: Measured round trip time in seconds
+        :param throughput: Measured download speed in bytes per second
+        :param success: Whether the last contact succeeded
+        :param useful_blocks: Number of blocks from this peer that were added to our chain
+        :param penalty: Penalty to be added
+        :return: None
+        """
+        if node_id not in self.peers:
+            return
+        alpha = self.engine.config['peers'].get('ewma_alpha', 0.3)
+        peer_history = self.get_peer_history(node_id)
+        if rtt is not None:
+            peer_history['rtt'] = ClientDB.ewma(peer_history['rtt'], rtt, alpha)
+        if throughput is not None:
+            peer_history['throughput'] = ClientDB.ewma(peer_history['throughput'], throughput, alpha)
+        if success is not None:
+            peer_history['success_rate'] = ClientDB.ewma(peer_history['success_rate'], 1 if success else 0, alpha)
+            if success:
+                peer_history['penalty'] *= 1 - alpha
+        if useful_blocks is not None:
+            peer_history['useful_blocks'] = ClientDB.ewma(peer_history['useful_blocks'], useful_blocks, alpha)
+        if penalty is not None:
+            peer_history['penalty'] += penalty
+        self.set_peer_history(node_id, peer_history)
+
+        peer = copy.deepcopy(self.peers[node_id])
+        peer['rank'] = ClientDB.peer_score(peer_history)
+        self._set_peer(peer)
+
+    @lockit('peers')
+    def ban_peer(self, node_id, duration=None):
+        """
+        Ban a peer by its node id and IP address. Banned peers are removed from the table,
+        cannot be added again and their requests are refused until the ban expires.
+        :param node_id: Node id of the peer
+        :param duration: Ban duration in seconds. Defaults to config value ban_time.
+        :return: None
+        """
+        if duration is None:
+            duration = self.engine.config['peers'].get('ban_time', 24 * 60 * 60)
+        until = time.time() + duration
+        peer = self.peers.get(node_id, None)
+        self._add_bans([node_id] if peer is None else [node_id, peer['ip']], until)
+        if peer is not None:
+            self._remove_peer(node_id)
+        api.peer_update()
+
+    @lockit('peer_bans')
+    def _add_bans(self, keys, until):
+        for key in keys:
+            self.bans[key] = until
+        self.dirty_bans = True
+
+    @lockit('peer_bans')
+    def is_banned(self, key):
+        """
+        :param key: Node id or IP address
+        :return: Whether there is an active ban on given key
+        """
+        return self.bans.get(key, 0) > time.time()
+
+    @lockit('peer_bans')
+    def get_bans(self):
+        return {key: until for key, until in self.bans.items() if until > time.time()}
+
+    @lockit('peers')
+    def peer_at_ip(self, ip, port=None):
+        """
+        Inbound requests name their sender only in a header that anyone can write. Charge them to
+        the address they came from instead. Several nodes may share an IP behind NAT, so an IP alone
+        never stands for a peer in table.
+        :param ip: Remote IP address of a connection
+        :param port: Listening port of remote, if known
+        :return: Node id of the peer in table at (ip, port), or the IP itself
+        """
+        if port is not None:
+            return self.peer_addresses.get((ip, port), ip)
+        return ip
+
+    @lockit('peers')
+    def report_false_blocks(self, node_id):
+        """
+        Penalize a peer that sent blocks we could not add. After ban_threshold reports, the peer is banned.
+        :param node_id: Node id of the peer, or IP address of an inbound host. Bans on an IP cover every node behind it.
+        :return: None
+        """
+        threshold = self.engine.config['peers'].get('ban_threshold', 3)
+        if node_id not in self.peers:
+            if tools.is_ip_address(node_id):
+                self.ip_false_blocks[node_id] = self.ip_false_blocks.get(node_id, 0) + 1
+                if self.ip_false_blocks[node_id] >= threshold:
+                    del self.ip_false_blocks[node_id]
+                    self.ban_peer(node_id)
+            return
+        self.update_peer_metrics(node_id, penalty=self.engine.config['peers'].get('false_block_penalty', 30))
+
+        peer_history = self.get_peer_history(node_id)
+        peer_history['false_blocks'] += 1
+        self.set_peer_history(node_id, peer_history)
+        if peer_history['false_blocks'] >= threshold:
+            self.ban_peer(node_id)
+
+    def _mark_added(self, node_id):
+        peer_history = self.get_peer_history(node_id)
+        peer_history['added'] = time.time()
+        peer_history['tries'] = 0
+        self.set_peer_history(node_id, peer_history)
+
     @lockit('peers')
     def get_peer(self, node_id):
-        peers = self.get_peers()
-        for _peer in peers:
-            if _peer['node_id'] == node_id:
-                return _peer
-        return None
+        peer = self.peers.get(node_id, None)
+        return copy.deepcopy(peer) if peer is not None else None
+
+    @lockit('peers')
+    def get_peer_by_address(self, ip, port):
+        node_id = self.peer_addresses.get((ip, port), None)
+        return self.get_peer(node_id)
 
     @lockit('peers')
     def get_peers(self):
-        peers = self.get('peer_list')
-        if peers is None:
-            peers = list()
-        peers = sorted(peers, key=lambda x: x['rank'])
-        return peers
+        """
+        :return: Copies of all peers ordered by rank
+        """
+        return sorted(copy.deepcopy(list(self.peers.values())), key=lambda x: x['rank'])
+
+    @lockit('peers')
+    def sample_peer(self, ahead_of=None):
+        """
+        Pick a random peer. Lower ranked peers are more likely to be picked.
+        Weight of a peer is inversely proportional to its rank.
+        :param ahead_of: If given, only peers that reported a longer chain are considered.
+        Weights are squared so that downloads go to the fastest honest peers.
+        :return: A copy of the picked peer or None
+        """
+        peers = list(self.peers.values())
+        power = 1
+        if ahead_of is not None:
+            ahead = [peer for peer in peers if peer['length'] > ahead_of]
+            if len(ahead) > 0:
+                peers = ahead
+                power = 2
+        if len(peers) == 0:
+            return None
+        weights = [(1.0 / (0.1 + max(peer['rank'], 0))) ** power for peer in peers]
+        return copy.deepcopy(random.choices(peers, weights=weights)[0])
+
+    @lockit('peers')
+    def get_peer_summary(self, exclude=()):
+        """
+        :param exclude: Node ids to leave out. Two peers leave out both of their own ids,
+        as each of them knows the other but not itself.
+        :return: dict of short peer ids to peer dicts. Short id is the first block of a node_id.
+        """
+        excluded = {node_id[:8] for node_id in exclude if isinstance(node_id, str)}
+        return {_peer['node_id'][:8]: _peer for _peer in self.get_peers() if _peer['node_id'][:8] not in excluded}
+
+    @staticmethod
+    def peer_digest(summary):
+        """
+        :param summary: Output of get_peer_summary
+        :return: Hash of known short peer ids. Two nodes that know the same peers have the same digest.
+        """
+        return tools.det_hash(sorted(summary.keys())).hex()
 
     @lockit('peers')
     def add_peer(self, peer, type):
@@ -100,46 +559,42 @@ class ClientDB:
         """
         if not self.is_peer(peer):
             return
+        if self.is_banned(peer['node_id']) or self.is_banned(peer['ip']):
+            return
 
-        peers = self.get_peers()
+        peer = copy.deepcopy(peer)
+        same_node = self.peers.get(peer['node_id'], None)
+        same_ip_port = self.peers.get(self.peer_addresses.get((peer['ip'], peer['port']), None), None)
 
         if type == 'greetings':
-            same_node = []
-            same_ip_port = []
-            add_flag = True
-            for i, _peer in enumerate(peers):
-                if _peer['node_id'] == peer['node_id'] and _peer['ip'] == peer['ip'] and \
-                                _peer['port'] == peer['port']:
-                    peer['rank'] *= _peer['rank']
-                    peers[i] = peer
-                    add_flag = False
-                    break
-                elif _peer['node_id'] == peer['node_id']:
-                    same_node.append(i)
-                elif _peer['port'] == peer['port'] and _peer['ip'] == peer['ip']:
-                    same_ip_port.append(i)
-
-            for i in same_node:
-                peers[i]['ip'] = peer['ip']
-                peers[i]['port'] = peer['port']
-                add_flag = False
-
-            for i in reversed(same_ip_port):
-                del peers[i]
-
-            if add_flag:
-                peers.append(peer)
+            if same_ip_port is not None and same_ip_port['node_id'] != peer['node_id']:
+                self._remove_peer(same_ip_port['node_id'])
 
-        elif type == 'friend_of_mine':
-            for _peer in peers:
-                if peer['node_id'] == _peer['node_id'] or \
-                        (peer['ip'] == _peer['ip'] and peer['port'] == _peer['port']):
+            if same_node is None:
+                if not self._make_room(peer, force=True):
                     return
+                self._set_peer(peer)
+                self._mark_added(peer['node_id'])
+            elif same_node['ip'] == peer['ip'] and same_node['port'] == peer['port']:
+                # Rank is derived from measured metrics. Greetings do not change it.
+                peer['rank'] = same_node['rank']
+                self._set_peer(peer)
+            else:
+                new_peer = copy.deepcopy(same_node)
+                new_peer['ip'] = peer['ip']
+                new_peer['port'] = peer['port']
+                self._set_peer(new_peer)
+
+        elif type == 'friend_of_mine':
+            if same_node is not None or same_ip_port is not None:
+                return
+            if not self._make_room(peer, force=False):
+                return
             peer['rank'] = 10
-            peers.append(peer)
+            self._set_peer(peer)
+            self._mark_added(peer['node_id'])
 
         api.peer_update()
-        self.put('peer_list', peers)
 
     @lockit('peers')
     def update_peer(self, peer):
@@ -151,14 +606,10 @@ class ClientDB:
         if not self.is_peer(peer):
             return
 
-        peers = self.get('peer_list')
-        for i, _peer in enumerate(peers):
-            if peer['node_id'] == _peer['node_id']:
-                peers[i] = peer
-                break
-
+        if peer['node_id'] not in self.peers:
+            return
+        self._set_peer(copy.deepcopy(peer))
         api.peer_update()
-        self.put('peer_list', peers)
 
     @lockit('peers')
     def is_peer(self, peer):
@@ -186,19 +637,36 @@ class ClientDB:
 
         return True
 
-    @lockit('peers')
+    @lockit('peer_histories')
     def get_peer_history(self, node_id):
-        if self.get('peer_history_' + node_id) is not None:
-            return self.get('peer_history_' + node_id)
-        else:
-            return {
-                "greetings": 0,
-                "peer_transfer": 0
-            }
+        if node_id not in self.peer_histories:
+            peer_history = copy.deepcopy(ClientDB.default_peer_history)
+            if self.get('peer_history_' + node_id) is not None:
+                peer_history.update(self.get('peer_history_' + node_id))
+            self.peer_histories[node_id] = peer_history
+        return copy.deepcopy(self.peer_histories[node_id])
+
+    @lockit('peer_histories')
+    def set_peer_history(self, node_id, peer_history):
+        self.peer_histories[node_id] = copy.deepcopy(peer_history)
+        self.dirty_histories.add(node_id)
+        self.removed_histories.discard(node_id)
 
     @lockit('peers')
-    def set_peer_history(self, node_id, peer_history):
-        self.put('peer_history_' + node_id, peer_history)
+    def add_peer_traffic(self, node_id, stats):
+        """
+        Accumulate bytes exchanged with a peer. Raw is the size of serialized messages,
+        wire is what actually went through the socket after compression.
+        :param node_id: Node id of the peer
+        :param stats: dict filled by ntwrk send/receive
+        :return: None
+        """
+        if node_id not in self.peers or not isinstance(stats, dict):
+            return
+        peer_history = self.get_peer_history(node_id)
+        peer_history['bytes_raw'] += stats.get('raw_in', 0) + stats.get('raw_out', 0)
+        peer_history['bytes_wire'] += stats.get('wire_in', 0) + stats.get('wire_out', 0)
+        self.set_peer_history(node_id, peer_history)
 
     @lockit('wallets')
     def get_wallets(self):
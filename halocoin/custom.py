@@ -26,6 +26,14 @@ memoized_weights = [inflection ** i for i in range(history_length)]
 
 first_target = '0' * 4 + 'f' * 60
 
+# Known block hashes of the main chain, length: hash hex.
+# Imported block files must agree with them. Signatures are not verified below the highest checkpoint.
+checkpoints = {}
+
+# Blocks from this length on must commit to their txs and account state with txRoot and stateRoot.
+# Blocks below it may have been mined before header roots existed.
+header_roots_from = 100000
+
 
 def generate_default_config():
     config = dict()
@@ -55,7 +63,41 @@ def generate_default_config():
                 'length': -1
             }
         ],
-        "download_limit": 190
+        "download_limit": 190,
+        "compression": True,
+        "peer_digest_interval": 30,
+        "relay_count": 8,
+        "max_range": 201,
+        "limit_penalty": 1,
+        "persist_interval": 30,
+        "max_peers": 256,
+        "max_peers_per_subnet": 8,
+        "stale_time": 24 * 60 * 60,
+        "stale_tries": 50,
+        "ban_time": 24 * 60 * 60,
+        "ban_threshold": 3,
+        "ewma_alpha": 0.3,
+        "false_block_penalty": 30
+    }
+
+    config["blockchain"] = {
+        "pipeline_depth": 4,
+        "intake_size": 2000,
+        "orphan_size": 500,
+        "max_reorg_depth": 1000,
+        "verify_batch": 16
+    }
+
+    config["api"] = {
+        "max_addresses": 10000,
+        "cache_confirmations": 6,
+        "cache_size": 5000
+    }
+
+    config["light"] = {
+        "enabled": False,
+        "addresses": [],
+        "refresh_interval": 30
     }
 
     config["miner"] = {
@@ -9,6 +9,36 @@ from halocoin import tools, custom
 from halocoin.service import lockit
 
 
+class Snapshot:
+    """
+    Read-only view of the database at the moment it was taken.
+    Writes that happen later are not visible, so several reads through the same
+    snapshot are consistent with each other.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.length = self.get('length')
+
+    def get(self, key):
+        try:
+            return pickle.loads(self.snapshot.get(str(key).encode()))
+        except Exception as e:
+            return None
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def iterate(self, start, stop, reverse=False, raw=False):
+        """
+        :param raw: Give values as they are stored, without unpickling
+        """
+        iterator = self.snapshot.iterator(start=str(start).encode(), stop=str(stop).encode(), reverse=reverse)
+        if raw:
+            return ((key.decode(), value) for key, value in iterator)
+        return ((key.decode(), pickle.loads(value)) for key, value in iterator)
+
+
 class KeyValueStore:
     def __init__(self, engine, dbname):
         self.engine = engine
@@ -20,11 +50,16 @@ class KeyValueStore:
         self.salt = None
         self.req_count = 0
         self.log = dict()
+        self.read_snapshot = None
+        # Direct writes outside a simulation only mark the read snapshot as old. It is taken again
+        # when a reader asks for it, so write-heavy callers do not pay for a snapshot per write.
+        self.read_snapshot_stale = False
         try:
             db_location = os.path.join(self.engine.working_dir, self.dbname)
             DB = plyvel.DB(db_location, create_if_missing=True)
             self.DB = DB.prefixed_db(custom.version.encode())
             self.iterator = self.DB.iterator
+            self.read_snapshot = Snapshot(self.DB.snapshot())
         except Exception as e:
             tools.log(e)
             sys.stderr.write('Database connection cannot be established!\n')
@@ -52,8 +87,12 @@ class KeyValueStore:
                                        .format(tname))
             elif tname == self.simulation_owner and self.simulating:
                 self.log[str(key)] = value
+            elif not self.simulating and value is None:
+                self.DB.delete(str(key).encode())
+                self.read_snapshot_stale = True
             elif not self.simulating:
                 self.DB.put(str(key).encode(), pickle.dumps(value))
+                self.read_snapshot_stale = True
             return True
         except Exception as e:
             return False
@@ -66,6 +105,38 @@ class KeyValueStore:
     def delete(self, key):
         return self.put(key, None)
 
+    def reader(self):
+        """
+        Snapshot taken after the last committed write. Readers use it without waiting for
+        kvstore lock, so they never contend with block import.
+        :return: Snapshot
+        """
+        if self.read_snapshot_stale:
+            # Flag is cleared first. A write that lands meanwhile sets it again.
+            self.read_snapshot_stale = False
+            self.read_snapshot = Snapshot(self.DB.snapshot())
+        return self.read_snapshot
+
+    @lockit('kvstore')
+    def snapshot(self):
+        """
+        Take a snapshot of committed records. Simulation changes are not part of it.
+        :return: Snapshot
+        """
+        return Snapshot(self.DB.snapshot())
+
+    @lockit('kvstore')
+    def iterate(self, start, stop, reverse=False):
+        """
+        Range scan over committed records. Changes of an ongoing simulation are not visible.
+        :param start: First key, inclusive
+        :param stop: Last key, exclusive
+        :param reverse: Iterate from stop to start
+        :return: Generator of (key, value) pairs
+        """
+        iterator = self.DB.iterator(start=str(start).encode(), stop=str(stop).encode(), reverse=reverse)
+        return ((key.decode(), pickle.loads(value)) for key, value in iterator)
+
     @lockit('kvstore')
     def simulate(self):
         """
@@ -89,14 +160,21 @@ class KeyValueStore:
     @lockit('kvstore')
     def commit(self):
         """
-        Commit simply erases the earlier snapshot.
+        Commit writes every change of the simulation in a single write batch.
+        Either all of the changes reach the disk or none of them do.
         :return:
         """
         if not self.simulating:
             tools.log('There isn\'t any ongoing simulation')
             return False
-        for key, value in self.log.items():
-            self.DB.put(str(key).encode(), pickle.dumps(value))
+        with self.DB.write_batch() as wb:
+            for key, value in self.log.items():
+                if value is None:
+                    wb.delete(str(key).encode())
+                else:
+                    wb.put(str(key).encode(), pickle.dumps(value))
+        self.read_snapshot_stale = False
+        self.read_snapshot = Snapshot(self.DB.snapshot())
         self.log = dict()
         self.simulating = False
         return True
@@ -108,4 +186,9 @@ class KeyValueStore:
             return False
         self.log = dict()
         self.simulating = False
-        return True
\ No newline at end of file
+        return True
+
+    @lockit('kvstore')
+    def close(self):
+        self.read_snapshot = None
+        self.DB.db.close()
@@ -1,18 +1,22 @@
+import pickle
 import signal
 import sys
 import time
 
 import psutil
 
-from halocoin import api
+from halocoin import api, blockfile, custom, statefile
 from halocoin import tools
 from halocoin.blockchain import BlockchainService
 from halocoin.client_db import ClientDB
 from halocoin.database import KeyValueStore
+from halocoin.inventory import PeerInventory
+from halocoin.light import LightService
 from halocoin.miner import MinerService
 from halocoin.peer_check import PeerCheckService
 from halocoin.peer_listen import PeerListenService
 from halocoin.service import Service, async, threaded
+from halocoin.smt import is_empty_account
 from halocoin.state import StateDatabase
 
 
@@ -52,6 +56,8 @@ class Engine(Service):
         self.clientdb = ClientDB(self)
         self.statedb = StateDatabase(self)
         self.miner = MinerService(self)
+        self.inventory = PeerInventory()
+        self.light = LightService(self)
 
     def on_register(self):
         print('Starting halocoin')
@@ -60,18 +66,10 @@ class Engine(Service):
             tools.log("Database service is not working.")
             return False
 
-        b = self.db.get('init')
-        if not b:
-            print("Initializing records")
-            self.db.put('init', True)
-            self.db.put('length', -1)
-            self.db.put('peer_list', [])
-            self.db.put('targets', {})
-            self.db.put('times', {})
-            self.db.put('diffLength', '0')
-            self.db.put('accounts', {})
-            self.db.put('job_list', [])
-            self.clientdb.put('known_length', -1)
+        self.init_records()
+
+        if self.config.get('light', {}).get('enabled', False):
+            return self.start_light()
 
         if not self.blockchain.register():
             sys.stderr.write("Blockchain service has failed. Exiting!\n")
@@ -92,6 +90,43 @@ class Engine(Service):
 
         return True
 
+    def start_light(self):
+        """
+        Light mode runs only header sync next to API. Blockchain service is not started,
+        its database readers are still used by API and light service.
+        :return: Whether light mode started
+        """
+        self.blockchain.bind_databases()
+        if not self.light.register():
+            sys.stderr.write("Light service has failed. Exiting!\n")
+            self.unregister_sub_services()
+            return False
+
+        api.run()
+
+        return True
+
+    def init_records(self):
+        b = self.db.get('init')
+        if not b:
+            print("Initializing records")
+            self.db.put('init', True)
+            self.db.put('length', -1)
+            self.db.put('peer_list', [])
+            self.db.put('targets', {})
+            self.db.put('times', {})
+            self.db.put('diffLength', '0')
+            self.db.put('accounts', {})
+            self.db.put('job_list', [])
+            self.clientdb.put('known_length', -1)
+
+        self.statedb.migrate_history()
+        self.statedb.migrate_state_tree()
+
+    def close_databases(self):
+        self.db.close()
+        self.clientdb.close()
+
     def unregister_sub_services(self):
         running_services = set()
         if self.miner.get_state() == Service.RUNNING:
@@ -106,11 +141,16 @@ class Engine(Service):
         if self.blockchain.get_state() == Service.RUNNING:
             self.blockchain.unregister()
             running_services.add(self.blockchain)
+        if self.light.get_state() == Service.RUNNING:
+            self.light.unregister()
+            running_services.add(self.light)
 
         for service in running_services:
             service.join()
             print('Closed {}'.format(service.name))
 
+        self.clientdb.flush_peers()
+
     @threaded
     def stats(self):
         value = psutil.cpu_percent()
@@ -140,3 +180,290 @@ def main(config, working_dir):
         print("Shutting down gracefully")
     else:
         print("Couldn't start halocoin")
+
+
+def offline_engine(config, working_dir):
+    """
+    Engine with open databases and no running services. Used by commands that work on a stopped node.
+    :return: Engine or None if databases cannot be used
+    """
+    node = Engine(config, working_dir)
+    if not test_database(node.db):
+        print("Database service is not working.")
+        return None
+    node.init_records()
+    node.blockchain.bind_databases()
+    return node
+
+
+def import_blocks(config, working_dir, path, trusted_height=None, batch_size=500):
+    """
+    Import blocks from a block file while the node is not running.
+    Blocks are verified like blocks from network, except for tx signatures below trusted height.
+    Every batch of blocks is written to database at once. Blocks below trusted height are written
+    only when a checkpoint at or above them matches, or when the whole file is imported.
+    :param config: Node configuration
+    :param working_dir: Node directory
+    :param path: Block file that was created by export
+    :param trusted_height: Signatures are not checked below this length. Defaults to highest checkpoint.
+    :param batch_size: Number of blocks in a single database commit
+    :return: Number of imported blocks
+    """
+    if trusted_height is None:
+        trusted_height = max(custom.checkpoints.keys()) if len(custom.checkpoints) > 0 else -1
+    node = offline_engine(config, working_dir)
+    if node is None:
+        return 0
+
+    try:
+        return _import_blocks(node, path, trusted_height, batch_size)
+    finally:
+        node.close_databases()
+
+
+def _import_blocks(node, path, trusted_height, batch_size):
+    imported = 0
+    committed = 0
+    failed = False
+    # Blocks whose signatures were skipped are kept in the simulation until a checkpoint at or above
+    # them matches. A file that turns out wrong never leaves them written.
+    unchecked = False
+    started = time.time()
+    batch_started = started
+    node.db.simulate()
+    try:
+        with open(path, 'rb') as f:
+            for block in blockfile.read_blocks(f):
+                length = node.db.get('length')
+                checkpoint = custom.checkpoints.get(block['length'], None)
+                if checkpoint is not None and tools.block_hash(block).hex() != checkpoint:
+                    print('Block {} does not match the checkpoint'.format(block['length']))
+                    failed = True
+                    break
+                if block['length'] <= length:
+                    if node.blockchain.get_block_hash(block['length']) != tools.block_hash(block):
+                        print('Block {} is on a different chain than ours'.format(block['length']))
+                        failed = True
+                        break
+                    continue
+                check_signatures = block['length'] >= trusted_height
+                if not BlockchainService.block_integrity_check(block) or \
+                        not BlockchainService.block_stateless_check(block, check_signatures) or \
+                        node.blockchain.add_block(block, verified=True) != 0:
+                    print('Block {} is not valid'.format(block['length']))
+                    failed = True
+                    break
+                imported += 1
+                if not check_signatures:
+                    unchecked = True
+                if checkpoint is not None:
+                    # Hash of a checkpoint covers every block below it.
+                    unchecked = False
+                if imported % batch_size == 0 or (checkpoint is not None and imported > committed):
+                    if unchecked:
+                        continue
+                    node.db.commit()
+                    now = time.time()
+                    print('Imported up to {}, {:.1f} blocks/s'.format(block['length'],
+                                                                     (imported - committed) /
+                                                                     max(now - batch_started, 1e-6)))
+                    committed = imported
+                    batch_started = now
+                    node.db.simulate()
+    except (OSError, ValueError, pickle.UnpicklingError) as e:
+        print(e)
+        failed = True
+    except BaseException:
+        node.db.rollback()
+        raise
+
+    if not failed and unchecked and any(length > node.db.get('length') for length in custom.checkpoints):
+        print('Blocks file ends before the checkpoint that covers blocks without signature checks')
+        failed = True
+    if failed:
+        # A failing block may have changed state partially. Committed blocks are verified or
+        # covered by a checkpoint, everything after them is dropped.
+        node.db.rollback()
+        imported = committed
+    else:
+        # Unchecked blocks that are left have no checkpoint above them. They are below the trusted
+        # height that caller asked for and the whole file is valid.
+        node.db.commit()
+    elapsed = time.time() - started
+    print('Imported {} blocks in {:.1f} seconds, {:.1f} blocks/s'.format(imported, elapsed,
+                                                                         imported / max(elapsed, 1e-6)))
+    return imported
+
+
+def dump_state(config, working_dir, path, height=None):
+    """
+    Write account state at given length into a state file while the node is not running.
+    Chain is unwound in a simulation to reach an earlier length, so database is left untouched.
+    Recent blocks that are needed to validate following blocks are written along with accounts.
+    :param config: Node configuration
+    :param working_dir: Node directory
+    :param path: State file to create
+    :param height: Chain length of the state. Defaults to our top block.
+    :return: Hash of the written state or None
+    """
+    node = offline_engine(config, working_dir)
+    if node is None:
+        return None
+    try:
+        return _dump_state(node, path, height)
+    finally:
+        node.close_databases()
+
+
+def _dump_state(node, path, height):
+    length = node.db.get('length')
+    height = length if height is None else int(height)
+    if height < 0 or height > length:
+        print('Chain length is {}. State at {} cannot be written'.format(length, height))
+        return None
+
+    node.db.simulate()
+    try:
+        for i in range(length, height, -1):
+            node.statedb.rollback_block(node.blockchain.get_block(i))
+            node.db.put('length', i - 1)
+
+        top_block = node.blockchain.get_block(height)
+        root = node.statedb.tree.root()
+        # Loading a state checks it against the top block, a file that cannot pass is not written.
+        if 'stateRoot' in top_block and root != top_block['stateRoot']:
+            print('State root {} after unwinding to {} does not match {} in the block. '
+                  'State at {} cannot be written'.format(root.hex(), height, top_block['stateRoot'].hex(), height))
+            return None
+        hasher = statefile.StateHasher()
+        accounts = 0
+        blocks = 0
+        with open(path, 'wb') as f:
+            f.write(statefile.MAGIC)
+            statefile.write_record(f, 'header', {'version': custom.version,
+                                                 'height': height,
+                                                 'hash': tools.block_hash(top_block).hex(),
+                                                 'state_root': root.hex()})
+            # Every address starts with digits. Accounts are never removed at a later length,
+            # so addresses on disk cover every account at this length.
+            for address, stored in node.db.iterate('0', ':'):
+                if not tools.is_address_valid(address):
+                    continue
+                account = node.db.get(address)
+                # Empty accounts are not part of the state, rollbacks may leave their records behind.
+                if is_empty_account(account):
+                    continue
+                account.pop('tx_blocks', None)
+                statefile.write_record(f, 'account', address, account)
+                hasher.add(address, account)
+                accounts += 1
+            start = max(0, height - max(custom.history_length, custom.recalculate_target_at))
+            for i in range(start, height + 1):
+                statefile.write_record(f, 'block', node.blockchain.get_block(i))
+                blocks += 1
+            statefile.write_record(f, 'trailer', {'state_hash': hasher.hexdigest(),
+                                                  'accounts': accounts,
+                                                  'blocks': blocks})
+    finally:
+        node.db.rollback()
+    print('Wrote {} accounts and {} blocks at length {}. State hash {}'.format(accounts, blocks, height,
+                                                                               hasher.hexdigest()))
+    return hasher.hexdigest()
+
+
+def load_state(config, working_dir, path):
+    """
+    Fill an empty node from a state file. Node then syncs only the blocks after the state.
+    Chain cannot be unwound below the length of loaded state.
+    :param config: Node configuration
+    :param working_dir: Node directory
+    :param path: State file written by dump_state
+    :return: Whether state is loaded
+    """
+    node = offline_engine(config, working_dir)
+    if node is None:
+        return False
+    try:
+        return _load_state(node, path)
+    finally:
+        node.close_databases()
+
+
+def _load_state(node, path):
+    if node.db.get('length') != -1:
+        print('State can only be loaded into an empty chain')
+        return False
+
+    header = None
+    trailer = None
+    hasher = statefile.StateHasher()
+    last_address = ''
+    last_block = None
+    # State tree is built along with accounts, so its root is checked before anything is written.
+    tree_batch = {}
+    node.db.simulate()
+    try:
+        with open(path, 'rb') as f:
+            for record in statefile.read_records(f):
+                if header is None:
+                    if record[0] != 'header' or record[1].get('version', None) != custom.version:
+                        raise ValueError('State file does not belong to version {}'.format(custom.version))
+                    header = record[1]
+                elif record[0] == 'account':
+                    address, account = record[1], record[2]
+                    if address <= last_address or not tools.is_address_valid(address):
+                        raise ValueError('Accounts in state file are not in order')
+                    node.db.put(address, account)
+                    hasher.add(address, account)
+                    last_address = address
+                    tree_batch[address] = account
+                    if len(tree_batch) == 10000:
+                        node.statedb.tree.update(tree_batch)
+                        tree_batch = {}
+                elif record[0] == 'block':
+                    block = record[1]
+                    if not BlockchainService.block_integrity_check(block) or \
+                            not BlockchainService.block_stateless_check(block, check_signatures=False) or \
+                            (last_block is not None and
+                             (block['length'] != last_block['length'] + 1 or
+                              block['prevHash'] != tools.block_hash(last_block))):
+                        raise ValueError('Block {} in state file is not valid'.format(block.get('length', None)))
+                    node.blockchain.put_block(block['length'], block)
+                    last_block = block
+                elif record[0] == 'trailer':
+                    trailer = record[1]
+                    break
+
+        if trailer is None or last_block is None:
+            raise ValueError('State file is truncated')
+        if last_block['length'] != header['height'] or tools.block_hash(last_block).hex() != header['hash']:
+            raise ValueError('Blocks in state file do not end at length {}'.format(header['height']))
+        checkpoint = custom.checkpoints.get(header['height'], None)
+        if checkpoint is not None and checkpoint != header['hash']:
+            raise ValueError('State file does not match the checkpoint at {}'.format(header['height']))
+        if hasher.hexdigest() != trailer['state_hash']:
+            raise ValueError('State hash does not match the accounts in state file')
+        # Header of the file is not covered by proof of work, state root of the top block is.
+        if 'stateRoot' not in last_block:
+            raise ValueError('Block {} does not commit to account state'.format(header['height']))
+        root = node.statedb.tree.update(tree_batch)
+        if root != last_block['stateRoot']:
+            raise ValueError('State root {} does not match {} in block {}'.format(
+                root.hex(), last_block['stateRoot'].hex(), header['height']))
+    except (OSError, ValueError, pickle.UnpicklingError) as e:
+        print(e)
+        node.db.rollback()
+        return False
+    except BaseException:
+        node.db.rollback()
+        raise
+
+    node.db.put('length', header['height'])
+    node.db.put('diffLength', last_block['diffLength'])
+    node.db.put('state_base', header['height'])
+    node.db.put(StateDatabase.root_key(header['height']), root)
+    node.db.put('smt_compact', True)
+    node.db.commit()
+    print('Loaded state at length {}. State hash {}, state root {}'.format(header['height'],
+                                                                          trailer['state_hash'], root.hex()))
+    return True
@@ -0,0 +1,179 @@
+import queue
+import threading
+from collections import deque, OrderedDict
+
+from halocoin import tools
+
+
+class BlockIntake:
+    """
+    Buffer of block candidates waiting for verification.
+    A candidate is a list of consecutive blocks and the node id of the peer that sent them.
+    Every block is keyed by its length and hash. A candidate whose blocks are all pending already
+    is a duplicate and is not queued again. Capacity is counted in blocks. When buffer is full,
+    put waits until there is room or timeout passes, so that downloaders slow down instead of
+    losing what they fetched silently.
+    Keys stay pending until release is called after the candidate is processed.
+    """
+
+    def __init__(self, max_blocks=2000):
+        self.max_blocks = max_blocks
+        self.items = deque()
+        self.pending = {}
+        self.size = 0
+        self.condition = threading.Condition()
+        self.stats = {
+            'accepted': 0,
+            'duplicate': 0,
+            'dropped': 0
+        }
+
+    @staticmethod
+    def block_keys(blocks):
+        keys = []
+        for block in blocks:
+            try:
+                keys.append((block['length'], tools.block_hash(block)))
+            except Exception:
+                pass
+        return keys
+
+    def put(self, candidate, block=True, timeout=None):
+        """
+        :param candidate: (blocks, node_id)
+        :param block: Whether to wait for room
+        :param timeout: Maximum time to wait in seconds. None waits forever.
+        :return: Whether candidate is queued. Duplicates count as queued.
+        """
+        blocks, node_id = candidate
+        if not isinstance(blocks, list) or len(blocks) == 0:
+            return False
+        keys = BlockIntake.block_keys(blocks)
+        with self.condition:
+            if len(keys) == len(blocks) and all(key in self.pending for key in keys):
+                self.stats['duplicate'] += len(blocks)
+                return True
+
+            if self.size + len(blocks) > self.max_blocks and self.size > 0:
+                if not block or not self.condition.wait_for(
+                        lambda: self.size + len(blocks) <= self.max_blocks or self.size == 0, timeout):
+                    self.stats['dropped'] += len(blocks)
+                    return False
+
+            for key in keys:
+                self.pending[key] = self.pending.get(key, 0) + 1
+            self.items.append((blocks, node_id, keys))
+            self.size += len(blocks)
+            self.stats['accepted'] += len(blocks)
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """
+        :param timeout: Maximum time to wait for a candidate
+        :return: (blocks, node_id, keys). Keys must be given back to release after processing.
+        :raises queue.Empty: if there is no candidate in time
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0, timeout):
+                raise queue.Empty
+            item = self.items.popleft()
+            self.size -= len(item[0])
+            self.condition.notify_all()
+            return item
+
+    def release(self, keys):
+        """
+        Candidate is processed. Same blocks can be queued again.
+        :param keys: Keys returned by get
+        :return: None
+        """
+        with self.condition:
+            for key in keys:
+                count = self.pending.get(key, 0) - 1
+                if count <= 0:
+                    self.pending.pop(key, None)
+                else:
+                    self.pending[key] = count
+
+    def empty(self):
+        with self.condition:
+            return len(self.items) == 0
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['queued_blocks'] = self.size
+            stats['pending_blocks'] = len(self.pending)
+            return stats
+
+
+class OrphanPool:
+    """
+    Blocks that arrived before their parent. They are indexed by hash and by prevHash.
+    When a block is added to the chain, its waiting descendants can be found by its hash.
+    Pool is bounded. Oldest orphans are evicted first.
+    """
+
+    def __init__(self, max_blocks=500):
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.children = {}
+        self.lock = threading.RLock()
+        self.stats = {
+            'added': 0,
+            'connected': 0,
+            'evicted': 0
+        }
+
+    def add(self, blocks, node_id):
+        """
+        :param blocks: Verified blocks whose parents are not in our chain yet
+        :param node_id: Where blocks came from
+        :return: None
+        """
+        with self.lock:
+            for block in blocks:
+                block_hash = tools.block_hash(block)
+                if block_hash in self.blocks:
+                    continue
+                self.blocks[block_hash] = (block, node_id)
+                self.children.setdefault(block['prevHash'], []).append(block_hash)
+                self.stats['added'] += 1
+            while len(self.blocks) > self.max_blocks:
+                self.__remove(next(iter(self.blocks)))
+                self.stats['evicted'] += 1
+
+    def __remove(self, block_hash):
+        block, node_id = self.blocks.pop(block_hash)
+        siblings = self.children.get(block['prevHash'], [])
+        if block_hash in siblings:
+            siblings.remove(block_hash)
+        if len(siblings) == 0:
+            self.children.pop(block['prevHash'], None)
+        return block, node_id
+
+    def pop_chain(self, parent_hash):
+        """
+        Remove and return the longest run of orphans that starts from given parent.
+        If there are competing children, the one that arrived first is followed.
+        :param parent_hash: Hash of the block that is now on top of our chain
+        :return: (blocks, node_id of the first block). Blocks is empty if nothing is waiting.
+        """
+        with self.lock:
+            chain = []
+            node_id = None
+            while parent_hash in self.children and len(self.children[parent_hash]) > 0:
+                block, _node_id = self.__remove(self.children[parent_hash][0])
+                if node_id is None:
+                    node_id = _node_id
+                chain.append(block)
+                parent_hash = tools.block_hash(block)
+            self.stats['connected'] += len(chain)
+            return chain, node_id
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.blocks)
+            return stats
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+from halocoin.service import lockit
+
+
+class PeerInventory:
+    """
+    Remembers which transaction and block hashes are known by each peer.
+    A hash is known by a peer if we announced it to them or they announced it to us.
+    Known hashes are never announced again to the same peer.
+    Memory is bounded both in number of peers and hashes per peer. Oldest entries are forgotten first.
+    """
+
+    def __init__(self, max_peers=256, max_hashes=20000):
+        self.max_peers = max_peers
+        self.max_hashes = max_hashes
+        self.known = OrderedDict()
+
+    @lockit('inventory')
+    def mark(self, node_id, hashes):
+        """
+        Record hashes as known by the peer.
+        :param node_id: Node id of the peer
+        :param hashes: iterable of hashes
+        :return: None
+        """
+        if node_id not in self.known:
+            self.known[node_id] = OrderedDict()
+            while len(self.known) > self.max_peers:
+                self.known.popitem(last=False)
+        self.known.move_to_end(node_id)
+        peer_known = self.known[node_id]
+        for _hash in hashes:
+            peer_known[_hash] = True
+            peer_known.move_to_end(_hash)
+        while len(peer_known) > self.max_hashes:
+            peer_known.popitem(last=False)
+
+    @lockit('inventory')
+    def unknown(self, node_id, hashes):
+        """
+        :param node_id: Node id of the peer
+        :param hashes: iterable of hashes
+        :return: hashes that the peer does not know yet, in the given order
+        """
+        peer_known = self.known.get(node_id, {})
+        return [_hash for _hash in hashes if _hash not in peer_known]
+
+    @lockit('inventory')
+    def forget(self, node_id):
+        if node_id in self.known:
+            del self.known[node_id]
@@ -0,0 +1,298 @@
+import time
+
+from halocoin import ntwrk, smt, tools
+from halocoin.blockchain import BlockchainService
+from halocoin.service import Service, threaded, lockit
+from halocoin.state import StateDatabase
+
+
+class LightService(Service):
+    """
+    Light mode of a node. Only block headers are downloaded and checked: targets against the retarget
+    rule, proof of work, links between headers and accumulated difficulty. Heaviest header chain wins.
+    Accounts and histories of watched addresses are fetched from peers with proofs that are checked
+    against state and tx roots in our headers. Full blocks, mempool and mining are not part of light mode.
+    A peer can prove that a tx is in a block but not that it sent every tx of an address.
+    """
+
+    def __init__(self, engine):
+        Service.__init__(self, name='light')
+        self.engine = engine
+        self.db = None
+        self.blockchain = None
+        self.clientdb = None
+        self.statedb = None
+        self.node_id = "Anon"
+
+    def on_register(self):
+        self.db = self.engine.db
+        self.blockchain = self.engine.blockchain
+        self.clientdb = self.engine.clientdb
+        self.statedb = self.engine.statedb
+        for peer in self.engine.config['peers']['list']:
+            self.clientdb.add_peer(peer, 'friend_of_mine')
+        self.node_id = self.db.get('node_id')
+        print("Started Light Sync")
+        return True
+
+    @staticmethod
+    def header_key(length):
+        return 'header_' + str(length).zfill(12)
+
+    @staticmethod
+    def cursor_key(address):
+        return 'lightcursor_' + address
+
+    @staticmethod
+    def tx_key(length, index):
+        return 'lighttx_{}_{}'.format(str(length).zfill(12), str(index).zfill(6))
+
+    def get_header(self, length):
+        return self.db.get(LightService.header_key(length))
+
+    def watched_addresses(self):
+        return self.engine.config.get('light', {}).get('addresses', [])
+
+    @threaded
+    def sync_headers(self):
+        """
+        Follow the heaviest header chain among our peers.
+        :return:
+        """
+        peer = self.clientdb.sample_peer()
+        if peer is not None:
+            self.download_headers(peer)
+        time.sleep(1)
+
+    @threaded
+    def watch(self):
+        """
+        Refresh accounts and histories of watched addresses from a peer.
+        :return:
+        """
+        interval = self.engine.config.get('light', {}).get('refresh_interval', 30)
+        peer = self.clientdb.sample_peer()
+        if peer is not None:
+            for address in self.watched_addresses():
+                self.refresh_account(peer, address)
+                self.refresh_history(peer, address)
+        for i in range(int(interval * 10)):
+            if not self.threaded_running():
+                break
+            time.sleep(0.1)
+
+    @threaded
+    def persist(self):
+        """
+        Write behind in-memory peer table to client database. Peer check service does this
+        in full mode, it does not run in light mode.
+        :return:
+        """
+        interval = self.engine.config['peers'].get('persist_interval', 30)
+        for i in range(int(interval * 10)):
+            if not self.threaded_running():
+                break
+            time.sleep(0.1)
+        self.clientdb.evict_stale_peers()
+        self.clientdb.flush_peers()
+
+    def command(self, peer, message):
+        """
+        Send a command to a peer and record whether it answered.
+        :param peer: Peer dict
+        :param message: message to be sent
+        :return: response of the peer or None
+        """
+        t1 = time.time()
+        result = ntwrk.command((peer['ip'], peer['port']), message, self.node_id)
+        success = result is not None and not (isinstance(result, dict) and 'error' in result)
+        self.clientdb.record_contact(peer['node_id'], success, rtt=time.time() - t1)
+        return result if success else None
+
+    def download_headers(self, peer):
+        """
+        Download and check headers of peer's chain in chunks. Each chunk is checked once, when it arrives.
+        Headers are written as soon as the checked part of peer's chain has more work than ours,
+        however deep it leaves our chain.
+        :param peer: Peer dict
+        :return: None
+        """
+        count = self.command(peer, {'action': 'block_count'})
+        if not isinstance(count, dict) or \
+                int(count['diffLength'] or '0', 16) <= int(self.db.get('diffLength') or '0', 16):
+            return
+        fork_length = self.command(peer, {'action': 'locate', 'locator': self.blockchain.block_locator()})
+        if not isinstance(fork_length, int) or fork_length > self.db.get('length'):
+            return
+        limit = self.engine.config['peers']['download_limit']
+        headers = []
+        while fork_length + len(headers) < count['length']:
+            start = fork_length + len(headers) + 1
+            chunk = self.command(peer, {'action': 'headers', 'range': [start, min(count['length'], start + limit - 1)]})
+            if not isinstance(chunk, list) or len(chunk) == 0:
+                return
+            checked = len(headers)
+            headers.extend(chunk)
+            if not self.check_headers(fork_length, headers, checked):
+                self.clientdb.report_false_blocks(peer['node_id'])
+                return
+            if int(headers[-1]['diffLength'], 16) > int(self.db.get('diffLength') or '0', 16):
+                if self.add_headers(fork_length, headers) == 0:
+                    return
+                fork_length += len(headers)
+                headers = []
+
+    def check_headers(self, fork_length, headers, checked):
+        """
+        Check the headers of a branch that leaves our chain at fork_length.
+        Targets follow the same retarget rule as full blocks, computed from our headers up to
+        fork_length and branch headers after it.
+        :param fork_length: Length of the last header we share with the peer
+        :param headers: Consecutive headers after fork length
+        :param checked: Number of headers at the start that are already checked
+        :return: Whether headers after checked ones are valid
+        """
+        def header_at(length):
+            return headers[length - fork_length - 1] if length > fork_length else self.get_header(length)
+
+        for i in range(checked, len(headers)):
+            length = fork_length + 1 + i
+            if i > 0:
+                prev_hash, prev_diff_length = tools.block_hash(headers[i - 1]), headers[i - 1]['diffLength']
+            elif fork_length >= 0:
+                prev_hash, prev_diff_length = self.blockchain.get_block_hash(fork_length), \
+                                              self.get_header(fork_length)['diffLength']
+            else:
+                prev_hash, prev_diff_length = None, '0'
+            if not self.check_header(headers[i], length, prev_hash, prev_diff_length) or \
+                    headers[i]['target'] != BlockchainService.target_from(length, header_at):
+                return False
+        return True
+
+    def check_header(self, header, length, prev_hash, prev_diff_length):
+        """
+        :param header: Header or, for blocks without a tx root, full block
+        :param length: Expected length
+        :param prev_hash: Hash of the header before
+        :param prev_diff_length: Accumulated difficulty up to the header before
+        :return: Whether header can follow the previous one
+        """
+        if not BlockchainService.block_integrity_check(header) or header['length'] != length:
+            return False
+        if 'txs' in header:
+            if not BlockchainService.block_stateless_check(header, check_signatures=False):
+                return False
+        elif 'txRoot' not in header or 'stateRoot' not in header or 'nonce' not in header or \
+                not BlockchainService.has_only_block_fields(header) or \
+                tools.det_hash(tools.hash_without_nonce(header)) > header['target']:
+            return False
+        if length > 0 and header.get('prevHash', None) != prev_hash:
+            return False
+        if length == 0:
+            return header['diffLength'] == tools.hex_invert(header['target'])
+        return header['diffLength'] == tools.hex_sum(prev_diff_length, tools.hex_invert(header['target']))
+
+    @lockit('write_kvstore')
+    def add_headers(self, fork_length, headers):
+        """
+        Switch to the checked header chain that leaves ours at fork_length, if it has more work.
+        :param fork_length: Length of the last header we share with the peer
+        :param headers: Consecutive headers after fork length, checked by check_headers
+        :return: Number of headers added
+        """
+        length = self.db.get('length')
+        if fork_length > length or \
+                int(headers[-1]['diffLength'], 16) <= int(self.db.get('diffLength') or '0', 16):
+            return 0
+
+        self.db.simulate()
+        for unwound in range(length, fork_length, -1):
+            self.db.delete(LightService.header_key(unwound))
+            self.db.delete(BlockchainService.block_hash_key(unwound))
+        if length > fork_length:
+            self.drop_history_after(fork_length)
+        for header in headers:
+            self.db.put(BlockchainService.block_hash_key(header['length']), tools.block_hash(header))
+            stored = tools.block_header(header)
+            if 'nonce' in header:
+                stored['nonce'] = header['nonce']
+            self.db.put(LightService.header_key(header['length']), stored)
+        self.db.put('length', headers[-1]['length'])
+        self.db.put('diffLength', headers[-1]['diffLength'])
+        self.db.commit()
+        return len(headers)
+
+    def drop_history_after(self, fork_length):
+        """
+        History entries of watched addresses in unwound blocks are not valid anymore.
+        They are fetched again from the new chain.
+        """
+        for address in self.watched_addresses():
+            for length, index, directions in self.statedb.get_history(address):
+                if length <= fork_length:
+                    break
+                self.db.delete(StateDatabase.history_key(address, length, index))
+                self.db.delete(LightService.tx_key(length, index))
+            cursor = self.db.get(LightService.cursor_key(address))
+            if cursor is not None and cursor[0] > fork_length:
+                self.db.put(LightService.cursor_key(address), [fork_length, 999999])
+
+    def refresh_account(self, peer, address):
+        result = self.command(peer, {'action': 'state_proof', 'address': address})
+        if not isinstance(result, dict):
+            return
+        header = self.get_header(result['length'])
+        if header is None or 'stateRoot' not in header or \
+                self.blockchain.get_block_hash(result['length']) != result['hash']:
+            # Our headers are not there yet, peer is on another branch or this block does not commit to state.
+            return
+        if not smt.verify_proof(header['stateRoot'], address, result['account'], result['proof']):
+            self.clientdb.report_false_blocks(peer['node_id'])
+            return
+        self.store_account(address, result['account'])
+
+    @lockit('write_kvstore')
+    def store_account(self, address, account):
+        self.db.simulate()
+        if account is None:
+            self.db.delete(address)
+        else:
+            self.db.put(address, {'amount': account['amount'], 'count': account['count'], 'cache-length': -1})
+        self.db.commit()
+
+    def refresh_history(self, peer, address):
+        after = self.db.get(LightService.cursor_key(address))
+        entries = self.command(peer, {'action': 'address_history', 'address': address, 'after': after})
+        if not isinstance(entries, list):
+            return
+        verified = []
+        for length, index, directions, tx, proof, block_hash in entries:
+            header = self.get_header(length)
+            if header is None or self.blockchain.get_block_hash(length) != block_hash:
+                # Beyond our headers or on another branch. Continue from here later.
+                break
+            after = [length, index]
+            if 'txRoot' not in header:
+                # Older blocks cannot prove their txs.
+                continue
+            if proof is None or not tools.verify_tx_proof(header['txRoot'], tx, proof):
+                self.clientdb.report_false_blocks(peer['node_id'])
+                return
+            # Directions are derived from the tx itself, not taken from the peer.
+            directions = []
+            if tools.tx_owner_address(tx) == address:
+                directions.append('send')
+            if tx.get('to', None) == address:
+                directions.append('recv')
+            if len(directions) > 0:
+                verified.append((length, index, directions, tx))
+        self.store_history(address, verified, after)
+
+    @lockit('write_kvstore')
+    def store_history(self, address, entries, cursor):
+        self.db.simulate()
+        for length, index, directions, tx in entries:
+            self.db.put(StateDatabase.history_key(address, length, index), directions)
+            self.db.put(LightService.tx_key(length, index), tx)
+        self.db.put(LightService.cursor_key(address), cursor)
+        self.db.commit()
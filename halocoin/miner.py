@@ -48,6 +48,7 @@ class MinerService(Service):
     @threaded
     def worker(self):
         if not self.blockchain.tx_queue.empty() or not self.blockchain.blocks_queue.empty() or \
+                not self.blockchain.verified_queue.empty() or \
                 self.blockchain.get_chain_state() != BlockchainService.IDLE:
             time.sleep(0.1)
             return
@@ -100,7 +101,9 @@ class MinerService(Service):
                'time': time.time(),
                'diffLength': diffLength,
                'target': target_,
-               'prevHash': tools.det_hash(prev_block)}
+               'prevHash': self.blockchain.get_block_hash(prev_block['length']),
+               'txRoot': tools.tx_merkle_root(txs)}
+        out['stateRoot'] = self.statedb.get_state_root_after(out)
         return out
 
     def make_mint(self, pubkey):
@@ -118,6 +121,8 @@ class MinerService(Service):
                'target': target_,
                'diffLength': tools.hex_invert(target_),
                'txs': [self.make_mint(pubkey)]}
+        out['txRoot'] = tools.tx_merkle_root(out['txs'])
+        out['stateRoot'] = self.statedb.get_state_root_after(out)
         return out
 
     @lockit('write_kvstore')
@@ -141,7 +146,7 @@ class MinerService(Service):
                 return
             if 'nonce' in candidate_block:
                 candidate_block.pop('nonce')
-            halfHash = tools.det_hash(candidate_block)
+            halfHash = tools.half_hash(candidate_block)
             candidate_block['nonce'] = random.randint(0, 10000000000000000000000000000000000000000)
             current_hash = tools.det_hash({'nonce': candidate_block['nonce'], 'halfHash': halfHash})
             while current_hash > candidate_block['target']:
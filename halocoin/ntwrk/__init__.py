@@ -1,76 +1,172 @@
 import socket
 import uuid
+import zlib
 
 from halocoin.ntwrk.message import Message
 from halocoin.ntwrk.response import Response
 
 MAX_MESSAGE_SIZE = 1024
+# Frames are read in chunks of this size, so a claimed length never sizes a buffer by itself.
+RECEIVE_CHUNK_SIZE = 64 * 1024
+# Upper limit for a payload, both on wire and after decompression.
+MAX_FRAME_SIZE = 32 * 1024 * 1024
+# Frame header is "<length>[;<encoding>]", never longer than this.
+MAX_FRAME_HEADER_SIZE = 32
+# Messages smaller than this are sent as they are. Compression does not pay off for small payloads.
+COMPRESSION_THRESHOLD = 4096
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+
+def zlib_decompress(data, max_length):
+    decompressor = zlib.decompressobj()
+    payload = decompressor.decompress(data, max_length + 1)
+    if len(payload) > max_length:
+        raise ValueError('Decompressed payload is larger than {} bytes'.format(max_length))
+    return payload
+
+
+def lz4_decompress(data, max_length):
+    payload = lz4_frame.LZ4FrameDecompressor().decompress(data, max_length=max_length + 1)
+    if len(payload) > max_length:
+        raise ValueError('Decompressed payload is larger than {} bytes'.format(max_length))
+    return payload
+
+
+# name: (compress(data), decompress(data, max_length))
+codecs = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib_decompress)
+}
+if lz4_frame is not None:
+    codecs['lz4'] = (lz4_frame.compress, lz4_decompress)
+
+compression_enabled = True
+# Encodings that remote peers advertised in their last response, keyed by (ip, port)
+peer_encodings = {}
+
+
+def supported_encodings():
+    """
+    Encodings we can decode, ordered by preference.
+    :return: list of codec names
+    """
+    if not compression_enabled:
+        return []
+    return sorted(codecs.keys(), key=lambda name: name != 'lz4')
+
+
+def choose_encoding(accepted):
+    """
+    Pick the first encoding that both sides support.
+    :param accepted: Encodings advertised by remote
+    :return: codec name or None
+    """
+    if not isinstance(accepted, list):
+        return None
+    for encoding in supported_encodings():
+        if encoding in accepted:
+            return encoding
+    return None
 
 
 def receive(sock, **kwargs):
     """
     Receives a socket message one time. This is not a SMP message.
+    Frames are formatted as "<length>[;<encoding>]:<payload>" where length is the size of payload in bytes.
+    Frames and decompressed payloads larger than MAX_FRAME_SIZE are refused.
     :param sock: Socket
-    :param kwargs: 
+    :param kwargs: timeout, leftover and stats. If stats is a dict, received byte counts are written to it.
     :return:
     """
     args = dict(
         timeout=10,
-        leftover=''
+        leftover=b'',
+        stats=None
     )
     args.update(kwargs)
 
     try:
         sock.settimeout(args['timeout'])
 
-        string = args['leftover']
-        while string == '':
-            received = sock.recv(MAX_MESSAGE_SIZE).decode()
+        data = args['leftover']
+        while data.find(b':') < 0:
+            if len(data) > MAX_FRAME_HEADER_SIZE:
+                raise ValueError('Frame header is too long')
+            received = sock.recv(MAX_MESSAGE_SIZE)
             if len(received) == 0:
                 raise Exception('Socket is closed')
-            string += received
-
-        while string.find(':') < 0:
-            received = sock.recv(MAX_MESSAGE_SIZE).decode()
+            data += received
+
+        sep_loc = data.find(b':')
+        if sep_loc > MAX_FRAME_HEADER_SIZE:
+            raise ValueError('Frame header is too long')
+        frame_header = data[:sep_loc].decode().split(';')
+        length = int(frame_header[0])
+        encoding = frame_header[1] if len(frame_header) > 1 else None
+        if length < 0 or length > MAX_FRAME_SIZE:
+            raise ValueError('Frame of {} bytes is refused'.format(length))
+        if encoding is not None and encoding not in codecs:
+            raise ValueError('Unknown encoding {}'.format(encoding))
+        data = bytearray(data[sep_loc + 1:])
+
+        while len(data) < length:
+            received = sock.recv(min(RECEIVE_CHUNK_SIZE, length - len(data)))
             if len(received) == 0:
                 raise Exception('Socket is closed')
-            string += received
+            data += received
 
-        sep_loc = string.find(":")
-        length = int(string[:sep_loc])
-        string = string[sep_loc + 1:]
-
-        while len(string) < length:
-            received = sock.recv(MAX_MESSAGE_SIZE).decode()
-            if len(received) == 0:
-                raise Exception('Socket is closed')
-            string += received
-
-        received_string = string[:length]
-        leftover = string[length:]
-        return Response(True, received_string), leftover
+        payload = bytes(data[:length])
+        leftover = bytes(data[length:])
+        if encoding is not None:
+            payload = codecs[encoding][1](payload, MAX_FRAME_SIZE)
+        if isinstance(args['stats'], dict):
+            args['stats']['wire_in'] = args['stats'].get('wire_in', 0) + sep_loc + 1 + length
+            args['stats']['raw_in'] = args['stats'].get('raw_in', 0) + len(payload)
+        return Response(True, payload.decode()), leftover
 
     except socket.timeout:
         # Timed out
-        return Response(False, 'timeout'), ''
+        return Response(False, 'timeout'), b''
     except socket.error:
-        return Response(False, 'gg'), ''
+        return Response(False, 'gg'), b''
     except:
         import sys
-        return Response(False, sys.exc_info()), ''
+        return Response(False, sys.exc_info()), b''
 
 
-def send(_msg, sock):
-    msg = str(_msg)
+def send(_msg, sock, encoding=None, stats=None):
+    """
+    Sends a message as a single frame.
+    :param _msg: Message or string to be sent
+    :param sock: Socket
+    :param encoding: Codec name to compress the payload with. Payloads under COMPRESSION_THRESHOLD are never compressed.
+    :param stats: If given as dict, sent byte counts are written to it.
+    :return: whether the whole frame is sent
+    """
+    payload = str(_msg).encode()
+    raw_size = len(payload)
+    frame_header = str(len(payload))
+    if encoding in codecs and raw_size >= COMPRESSION_THRESHOLD:
+        compressed = codecs[encoding][0](payload)
+        if len(compressed) < raw_size:
+            payload = compressed
+            frame_header = str(len(payload)) + ';' + encoding
 
     sent = 0
     try:
-        msg = str(len(msg)) + ":" + msg
+        msg = (frame_header + ':').encode() + payload
         while sent < len(msg):
-            sent += sock.send(msg[sent:].encode())
+            sent += sock.send(msg[sent:])
     except Exception as e:
         return False
 
+    if isinstance(stats, dict):
+        stats['wire_out'] = stats.get('wire_out', 0) + sent
+        stats['raw_out'] = stats.get('raw_out', 0) + raw_size
     return sent == len(msg)
 
 
@@ -94,12 +190,16 @@ def connect(host='localhost', port=3699, ssl_args=None, unix_config=None, timeou
         return None
 
 
-def command(peer, message, node_id):
+def command(peer, message, node_id, stats=None):
     """
     This method is special for blockchain communication. It is a pipeline of
     connect, send and receive.
+    Every request advertises the encodings we can decode. Remote side compresses large
+    responses with one of them. Requests are compressed only if remote advertised
+    its encodings in an earlier response.
     :param peer: A peer object
     :param message: message to be sent
+    :param stats: Optional dict that collects raw and on-wire byte counts of this exchange
     :return: received response or error
     """
     from halocoin import custom
@@ -107,15 +207,19 @@ def command(peer, message, node_id):
     if sock is not None:
         message_id = uuid.uuid4()
         message['version'] = custom.version
-        result = send(Message(headers={'id': message_id, 'node_id': node_id}, body=message), sock)
+        headers = {'id': message_id, 'node_id': node_id, 'encodings': supported_encodings()}
+        encoding = choose_encoding(peer_encodings.get(tuple(peer[:2]), None))
+        result = send(Message(headers=headers, body=message), sock, encoding=encoding, stats=stats)
         if result:
-            response, leftover = receive(sock, timeout=20)
+            response, leftover = receive(sock, timeout=20, stats=stats)
             if response.getFlag():
                 response_msg = Message.from_yaml(response.getData())
+                if response_msg.get_header('encodings') is not None:
+                    peer_encodings[tuple(peer[:2])] = response_msg.get_header('encodings')
                 return response_msg.get_body()
         else:
             return 'Could not receive proper result'
     else:
         return 'Could not connect'
 
-    return None
\ No newline at end of file
+    return None
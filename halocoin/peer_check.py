@@ -3,7 +3,8 @@ import time
 from halocoin import blockchain
 from halocoin import ntwrk
 from halocoin import tools
-from halocoin.service import Service, threaded, sync
+from halocoin.client_db import ClientDB
+from halocoin.service import Service, threaded, sync, async
 
 
 class PeerCheckService(Service):
@@ -18,6 +19,7 @@ class PeerCheckService(Service):
         self.clientdb = None
         self.node_id = "Anon"
         self.old_peers = []
+        self.last_stats = {}
 
     def on_register(self):
         self.db = self.engine.db
@@ -40,51 +42,69 @@ class PeerCheckService(Service):
             time.sleep(0.1)
             return
 
-        peers = self.clientdb.get_peers()
-        if len(peers) > 0:
-            i = tools.exponential_random(3.0 / 4) % len(peers)
-            peer = peers[i]
-            t1 = time.time()
-            peer_result = self.peer_check(peer)
-            t2 = time.time()
-
-            peer['rank'] *= 0.8
-            if peer_result == 1:  # We give them blocks. They do not contribute much information
-                peer['rank'] += 0.4 * (t2 - t1)
-            elif peer_result == 2:  # We are at the same level. Treat them equal
-                peer['rank'] += 0.2 * (t2 - t1)
-            elif peer_result == 3:
-                # They give us blocks. Increase their rank.
-                # If blocks are faulty, they will get punished severely.
-                peer['rank'] += 0.1 * (t2 - t1)
-            else:
-                peer['rank'] += 0.2 * 30
-
-            self.clientdb.update_peer(peer)
+        # While we are behind, prefer the fastest peers that are ahead of us.
+        length = self.db.get('length')
+        known_length = self.clientdb.get('known_length')
+        behind = known_length is not None and known_length > length
+        peer = self.clientdb.sample_peer(ahead_of=length if behind else None)
+        if peer is not None:
+            # Rank is updated from measured metrics inside peer_check.
+            self.peer_check(peer)
 
         time.sleep(0.1)
 
+    @threaded
+    def persist(self):
+        """
+        Write behind in-memory peer table to client database.
+        :return:
+        """
+        interval = self.engine.config['peers'].get('persist_interval', 30)
+        for i in range(int(interval * 10)):
+            if not self.threaded_running():
+                break
+            time.sleep(0.1)
+        self.clientdb.evict_stale_peers()
+        self.clientdb.flush_peers()
+
+    def command(self, peer_ip_port, message, node_id):
+        """
+        Send a command to a peer and record the traffic in its history.
+        :param peer_ip_port: (ip, port) of the peer
+        :param message: message to be sent
+        :param node_id: Node id of the peer
+        :return: response of the peer
+        """
+        stats = {}
+        t1 = time.time()
+        result = ntwrk.command(peer_ip_port, message, self.node_id, stats=stats)
+        stats['elapsed'] = time.time() - t1
+        self.clientdb.add_peer_traffic(node_id, stats)
+        self.last_stats = stats
+        return result
+
     @sync
     def peer_check(self, peer):
         peer_ip_port = (peer['ip'], peer['port'])
-        greeted = ntwrk.command(peer_ip_port,
-                                {
-                                    'action': 'greetings',
-                                    'node_id': self.node_id,
-                                    'port': self.engine.config['port']['peers'],
-                                    'length': self.db.get('length'),
-                                    'diffLength': self.db.get('diffLength')
-                                },
-                                self.node_id)
-
-        if not isinstance(greeted, dict):
-            return None
-        if 'error' in greeted.keys():
+        greeted = self.command(peer_ip_port,
+                               {
+                                   'action': 'greetings',
+                                   'node_id': self.node_id,
+                                   'port': self.engine.config['port']['peers'],
+                                   'length': self.db.get('length'),
+                                   'diffLength': self.db.get('diffLength')
+                               },
+                               peer['node_id'])
+
+        if not isinstance(greeted, dict) or 'error' in greeted.keys():
+            self.clientdb.record_contact(peer['node_id'], False)
             return None
+        rtt = self.last_stats['elapsed']
 
         peer['diffLength'] = greeted['diffLength']
         peer['length'] = greeted['length']
         self.clientdb.update_peer(peer)
+        self.clientdb.record_contact(peer['node_id'], True, rtt=rtt)
 
         known_length = self.clientdb.get('known_length')
         if greeted['length'] > known_length:
@@ -102,54 +122,180 @@ class PeerCheckService(Service):
         # Only transfer peers at every minute.
         peer_history = self.clientdb.get_peer_history(peer['node_id'])
         if time.time() - peer_history['peer_transfer'] > 60:
-            my_peers = self.clientdb.get_peers()
-            their_peers = ntwrk.command(peer_ip_port, {'action': 'peers'}, self.node_id)
-            if type(their_peers) == list:
-                for p in their_peers:
-                    self.clientdb.add_peer(p, 'friend_of_mine')
-                for p in my_peers:
-                    ntwrk.command(peer_ip_port, {'action': 'receive_peer', 'peer': p}, self.node_id)
+            self.exchange_peers(peer_ip_port, peer['node_id'])
 
+            # Transfers above updated traffic counters. Read the history again before writing.
+            peer_history = self.clientdb.get_peer_history(peer['node_id'])
             peer_history['peer_transfer'] = time.time()
             self.clientdb.set_peer_history(peer['node_id'], peer_history)
 
         if them < us:
-            self.give_block(peer_ip_port, greeted['length'])
+            self.give_block(peer_ip_port, greeted['length'], peer['node_id'])
             return 1
         elif us == them:
-            self.ask_for_txs(peer_ip_port)
+            self.ask_for_txs(peer_ip_port, peer['node_id'])
             return 2
         else:
             self.download_blocks(peer_ip_port, greeted['length'], length, peer['node_id'])
             return 3
 
+    @async
+    def relay_block(self, block, origin):
+        """
+        Announce a newly added block to best ranked peers as a compact block.
+        Peers that already know the block, including where it came from, are skipped.
+        :param block: New top block
+        :param origin: Node id that sent us the block, or 'miner'
+        :return: None
+        """
+        block_hash = tools.block_hash(block).hex()
+        self.engine.inventory.mark(origin, [block_hash])
+        relay_count = self.engine.config['peers'].get('relay_count', 8)
+        for peer in self.clientdb.get_peers()[:relay_count]:
+            if len(self.engine.inventory.unknown(peer['node_id'], [block_hash])) > 0:
+                self.send_compact_block((peer['ip'], peer['port']), block, peer['node_id'])
+
+    def send_compact_block(self, peer_ip_port, block, node_id):
+        """
+        Send the header and short tx ids of a block. If remote cannot find some txs in its mempool,
+        send the compact block again with those txs filled in.
+        :return: Whether remote accepted the block
+        """
+        prefill = ()
+        for i in range(2):
+            compact = blockchain.BlockchainService.make_compact_block(block, prefill)
+            response = self.command(peer_ip_port, {'action': 'compact_block', 'compact': compact}, node_id)
+            if not isinstance(response, dict):
+                return False
+            if 'missing' in response:
+                prefill = set(response['missing'])
+            else:
+                accepted = response.get('status', None) == 'accepted'
+                if accepted:
+                    self.engine.inventory.mark(node_id, [compact['hash']])
+                return accepted
+        return False
+
+    def exchange_peers(self, peer_ip_port, node_id):
+        """
+        Digest based peer exchange. We send only a digest of our peer list. If digests match, nothing
+        else is transferred. Otherwise we send short ids of the peers we know, remote sends the peers
+        we lack and tells which of ours it lacks. Those are sent back in a single batch.
+        """
+        summary = self.clientdb.get_peer_summary(exclude=(self.node_id, node_id))
+        digest = ClientDB.peer_digest(summary)
+        response = self.command(peer_ip_port, {'action': 'peer_digest', 'digest': digest}, node_id)
+        if not isinstance(response, dict) or response.get('same', True):
+            return
+        response = self.command(peer_ip_port, {'action': 'peer_digest',
+                                               'digest': digest,
+                                               'ids': list(summary.keys())}, node_id)
+        if not isinstance(response, dict) or response.get('same', True):
+            return
+        for p in response.get('peers', []):
+            self.clientdb.add_peer(p, 'friend_of_mine')
+        wanted = [summary[short_id] for short_id in response.get('wanted', []) if short_id in summary]
+        if len(wanted) > 0:
+            self.command(peer_ip_port, {'action': 'receive_peers', 'peers': wanted}, node_id)
+
     def download_blocks(self, peer_ip_port, block_count_peer, length, node_id):
-        b = [max(0, length - 10), min(block_count_peer + 1,
-                                      length + self.engine.config['peers']['download_limit'])]
-        blocks = ntwrk.command(peer_ip_port, {'action': 'range_request', 'range': b}, self.node_id)
-        if isinstance(blocks, list):
-            self.blockchain.blocks_queue.put((blocks, node_id))
+        """
+        Download blocks starting from the last block that we share with the peer.
+        Common block is found by sending our block locator. Blocks of a fork are downloaded
+        in several ranges so that the whole side chain reaches the blockchain service at once.
+        """
+        fork_length = self.command(peer_ip_port, {'action': 'locate',
+                                                  'locator': self.blockchain.block_locator()}, node_id)
+        if not isinstance(fork_length, int):
+            # Peer does not know about locators.
+            fork_length = length - 10
+        max_depth = self.engine.config.get('blockchain', {}).get('max_reorg_depth', 1000)
+        start = max(0, min(fork_length, length), length - max_depth)
+        end = min(block_count_peer, length + self.engine.config['peers']['download_limit'])
+        max_range = self.engine.config['peers'].get('max_range', self.engine.config['peers']['download_limit'] + 11)
 
-    def ask_for_txs(self, peer_ip_port):
-        txs = ntwrk.command(peer_ip_port, {'action': 'txs'}, self.node_id)
+        blocks = []
+        while start <= end:
+            b = [start, min(end, start + max_range - 1)]
+            received = self.command(peer_ip_port, {'action': 'range_request', 'range': b}, node_id)
+            if self.last_stats['elapsed'] > 0 and self.last_stats.get('wire_in', 0) > 0:
+                self.clientdb.update_peer_metrics(node_id,
+                                                  throughput=self.last_stats['wire_in'] / self.last_stats['elapsed'])
+            if not isinstance(received, list) or len(received) == 0:
+                break
+            blocks += received
+            start = b[1] + 1
 
-        T = self.blockchain.tx_pool()
-        pushers = list(filter(lambda t: t not in txs, T))
-        for push in pushers:
-            ntwrk.command(peer_ip_port, {'action': 'push_tx', 'tx': push}, self.node_id)
+        if len(blocks) > 0:
+            # Wait for room in intake buffer. We do not download more while import is behind.
+            if not self.blockchain.blocks_queue.put((blocks, node_id), timeout=30):
+                tools.log('Block intake is full. Dropped {} blocks from {}'.format(len(blocks), node_id))
 
-        if not isinstance(txs, list):
+    def ask_for_txs(self, peer_ip_port, node_id):
+        """
+        Exchange tx inventories with a peer that is at the same level as us.
+        We announce short hashes of txs that the peer has not seen from us yet.
+        Peer answers with the hashes it wants and the hashes it has not announced to us yet.
+        Only missing txs are transferred, in one batch per direction.
+        """
+        inventory = self.engine.inventory
+        announce = inventory.unknown(node_id, self.blockchain.tx_pool_hashes())
+        response = self.command(peer_ip_port, {'action': 'inventory', 'txs': announce}, node_id)
+        if not isinstance(response, dict):
             return -1
-        new_txs = list(filter(lambda t: t not in txs, T))
-        for tx in new_txs:
-            self.blockchain.tx_queue.put(tx)
+
+        wanted = response.get('wanted', [])
+        offered = response.get('txs', [])
+        inventory.mark(node_id, [h for h in announce if h not in wanted])
+
+        pushers = self.blockchain.tx_pool_get(wanted)
+        if len(pushers) > 0:
+            self.command(peer_ip_port, {'action': 'push_txs', 'txs': pushers}, node_id)
+            inventory.mark(node_id, wanted)
+
+        # Offered hashes are only claims. They are marked as known once remote hands over the txs.
+        missing = [h for h in offered if not self.blockchain.tx_pool_has(h)]
+        if len(missing) > 0:
+            new_txs = self.command(peer_ip_port, {'action': 'get_txs', 'hashes': missing}, node_id)
+            if isinstance(new_txs, list):
+                received = []
+                for tx in new_txs:
+                    tx_hash = tools.tx_hash(tx)
+                    if tx_hash in missing:
+                        self.blockchain.tx_queue.put(tx)
+                        received.append(tx_hash)
+                inventory.mark(node_id, received)
         return 0
 
-    def give_block(self, peer_ip_port, block_count_peer):
-        blocks = []
+    def give_block(self, peer_ip_port, block_count_peer, node_id):
+        """
+        Peer is behind us. Announce hashes of the blocks around their top and push
+        blocks starting from the first one they do not have.
+        """
+        inventory = self.engine.inventory
         b = [max(block_count_peer - 5, 0), min(self.db.get('length'),
                                                block_count_peer + self.engine.config['peers']['download_limit'])]
+        announce = []
+        for i in range(b[0], b[1] + 1):
+            block_hash = self.blockchain.get_block_hash(i)
+            if block_hash is not None and len(inventory.unknown(node_id, [block_hash.hex()])) > 0:
+                announce.append([i, block_hash.hex()])
+
+        response = self.command(peer_ip_port, {'action': 'inventory', 'blocks': announce}, node_id)
+        if isinstance(response, dict) and isinstance(response.get('wanted_blocks', None), list):
+            wanted = response['wanted_blocks']
+            inventory.mark(node_id, [h for l, h in announce if l not in wanted])
+            if len(wanted) == 0:
+                return 0
+            b[0] = max(b[0], min(wanted))
+
+        if b[0] == b[1] and b[0] == self.db.get('length'):
+            # Peer only misses our top block. Compact relay is enough.
+            if self.send_compact_block(peer_ip_port, self.blockchain.get_block(b[0]), node_id):
+                return 0
+
+        blocks = []
         for i in range(b[0], b[1] + 1):
             blocks.append(self.blockchain.get_block(i))
-        ntwrk.command(peer_ip_port, {'action': 'push_block', 'blocks': blocks}, self.node_id)
+        self.command(peer_ip_port, {'action': 'push_block', 'blocks': blocks}, node_id)
         return 0
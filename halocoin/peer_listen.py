@@ -1,12 +1,14 @@
 import copy
 import socket
 import sys
+import time
 import uuid
 
 from halocoin import ntwrk, custom
 from halocoin import tools
 from halocoin.client_db import ClientDB
 from halocoin.ntwrk import Message
+from halocoin.ratelimit import RateLimiter
 from halocoin.service import Service, threaded, sync
 
 
@@ -18,6 +20,11 @@ class PeerListenService(Service):
         self.blockchain = None
         self.clientdb = None
         self.node_id = None
+        # Both are keyed by remote IP, node id in message header can be changed at will.
+        self.peer_digest_times = {}
+        # Remotes whose digest did not match ours, with the time of mismatch. They may send their ids once.
+        self.peer_digest_mismatches = {}
+        self.limiter = None
 
     def on_register(self):
         self.db = self.engine.db
@@ -28,6 +35,8 @@ class PeerListenService(Service):
             self.db.put('node_id', str(uuid.uuid4()))
 
         self.node_id = self.db.get('node_id')
+        ntwrk.compression_enabled = self.engine.config['peers'].get('compression', True)
+        self.limiter = RateLimiter(self.engine.config['peers'].get('limits', None))
 
         try:
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -53,18 +62,29 @@ class PeerListenService(Service):
     def listen(self):
         try:
             client_sock, address = self.s.accept()
-            response, leftover = ntwrk.receive(client_sock)
+            stats = {}
+            response, leftover = ntwrk.receive(client_sock, stats=stats)
             if response.getFlag():
                 message = Message.from_yaml(response.getData())
                 request = message.get_body()
                 try:
-                    if hasattr(self, request['action']) \
+                    if self.clientdb.is_banned(address[0]) or \
+                            self.clientdb.is_banned(message.get_header('node_id')):
+                        result = {'error': 'You are banned'}
+                    elif not self.limiter.allow(address[0], request['action']):
+                        result = {'error': 'Rate limit exceeded'}
+                        self.punish_peer(address[0])
+                    elif getattr(getattr(self, request['action'], None), 'thread_safe', False) \
                             and request['version'] == custom.version \
                             and message.get_header("node_id") != self.node_id:
                         kwargs = copy.deepcopy(request)
-                        if request['action'] == 'greetings':
+                        if request['action'] in ('greetings', 'peer_digest'):
                             kwargs['__remote_ip__'] = client_sock.getpeername()
-                        elif request['action'] == 'push_block':
+                        if request['action'] in ('push_block', 'compact_block', 'inventory', 'push_txs'):
+                            # Blocks that turn out false and hashes that remote claims to know are charged
+                            # to where they came from. Listening port of remote is not known here, so that is its IP.
+                            kwargs['node_id'] = self.clientdb.peer_at_ip(address[0])
+                        elif request['action'] == 'peer_digest':
                             kwargs['node_id'] = message.get_header("node_id")
                         del kwargs['action']
                         del kwargs['version']
@@ -75,14 +95,29 @@ class PeerListenService(Service):
                     result = 'Something went wrong while evaluating.\n'
                     tools.log(sys.exc_info())
                 response = Message(headers={'ack': message.get_header('id'),
-                                            'node_id': self.node_id},
+                                            'node_id': self.node_id,
+                                            'encodings': ntwrk.supported_encodings()},
                                    body=result)
-                ntwrk.send(response, client_sock)
+                ntwrk.send(response, client_sock,
+                           encoding=ntwrk.choose_encoding(message.get_header('encodings')),
+                           stats=stats)
                 client_sock.close()
+                self.limiter.charge_bytes(address[0], stats.get('wire_in', 0) + stats.get('wire_out', 0))
+                self.clientdb.add_peer_traffic(message.get_header('node_id'), stats)
         except Exception as e:
-            import time
             time.sleep(0.1)
 
+    def punish_peer(self, ip):
+        """
+        Peers that exceed their limits lose rank so that we check them less often.
+        Penalty goes to the peer table entry at remote address, claimed node id of remote is not trusted.
+        An inbound connection does not tell the listening port of remote, so a peer that shares its IP
+        with others is not charged. The IP is still held back by the limiter.
+        :param ip: Remote IP address
+        :return: None
+        """
+        self.clientdb.update_peer_metrics(self.clientdb.peer_at_ip(ip), penalty=self.engine.config['peers'].get('limit_penalty', 1))
+
     @sync
     def greetings(self, node_id, port, length, diffLength, __remote_ip__):
         """
@@ -123,6 +158,61 @@ class PeerListenService(Service):
         peer.update(rank=1)  # We do not care about earlier rank.
         self.clientdb.add_peer(peer, 'friend_of_mine')
 
+    @sync
+    def receive_peers(self, peers):
+        """
+        Batched version of receive_peer.
+        :param peers: list of peer dicts
+        :return: None
+        """
+        for peer in peers:
+            if isinstance(peer, dict):
+                peer.update(rank=1)
+                self.clientdb.add_peer(peer, 'friend_of_mine')
+
+    @sync
+    def peer_digest(self, node_id, digest, __remote_ip__, ids=None):
+        """
+        Compare remote's peer digest with ours. Remote sends its digest alone first. Only if digests
+        differ, remote asks again with short ids of its peers. Then we return the peers remote lacks
+        and the short ids of peers we lack.
+        A peer can ask for a digest comparison once in every peer_digest_interval seconds
+        and send its ids once after each mismatch.
+        :param node_id: Node id of remote. Remote leaves itself and us out of its digest, so do we.
+        :param digest: Digest of remote's peer list
+        :param __remote_ip__: IP address and port of remote, limits are applied per IP
+        :param ids: Short ids of remote's peers, only after a mismatch
+        :return: dict
+        """
+        interval = self.engine.config['peers'].get('peer_digest_interval', 30)
+        now = time.time()
+        ip = __remote_ip__[0]
+        summary = self.clientdb.get_peer_summary(exclude=(self.node_id, node_id))
+        same = ClientDB.peer_digest(summary) == digest
+        if ids is None:
+            if now - self.peer_digest_times.get(ip, 0) < interval:
+                return {'error': 'Too many peer digest requests'}
+            if len(self.peer_digest_times) > 1024:
+                # Entries older than interval do not limit anyone anymore.
+                self.peer_digest_times = {k: t for k, t in self.peer_digest_times.items() if now - t < interval}
+                self.peer_digest_mismatches = {k: t for k, t in self.peer_digest_mismatches.items()
+                                               if now - t < interval}
+            self.peer_digest_times[ip] = now
+            if not same:
+                self.peer_digest_mismatches[ip] = now
+            return {'same': same}
+
+        if now - self.peer_digest_mismatches.pop(ip, 0) > interval:
+            return {'error': 'Peer ids are only accepted after a digest mismatch'}
+        if same:
+            return {'same': True}
+        ids = set(ids)
+        return {
+            'same': False,
+            'peers': [_peer for short_id, _peer in summary.items() if short_id not in ids],
+            'wanted': [short_id for short_id in ids if short_id not in summary]
+        }
+
     @sync
     def block_count(self):
         length = self.db.get('length')
@@ -131,8 +221,18 @@ class PeerListenService(Service):
             d = self.db.get('diffLength')
         return {'length': length, 'diffLength': d}
 
+    @sync
+    def locate(self, locator):
+        # A real locator is logarithmic in chain length. Anything longer is cut.
+        if not isinstance(locator, list):
+            return -1
+        return self.blockchain.locate(locator[:128])
+
     @sync
     def range_request(self, range):
+        # Never serve more than max_range blocks in a single request.
+        max_range = self.engine.config['peers'].get('max_range', self.engine.config['peers']['download_limit'] + 11)
+        range = [int(range[0]), min(int(range[1]), int(range[0]) + max_range - 1)]
         out = []
         counter = 0
         while range[0] + counter <= range[1]:
@@ -142,6 +242,68 @@ class PeerListenService(Service):
             counter += 1
         return out
 
+    @sync
+    def headers(self, range):
+        """
+        Headers for light nodes. Blocks without a tx root cannot be checked from their header,
+        so they are sent in full.
+        """
+        max_range = self.engine.config['peers'].get('max_range', self.engine.config['peers']['download_limit'] + 11)
+        range = [int(range[0]), min(int(range[1]), int(range[0]) + max_range - 1)]
+        out = []
+        counter = 0
+        while range[0] + counter <= range[1]:
+            block = self.blockchain.get_block(range[0] + counter)
+            if not (block and 'length' in block):
+                break
+            if 'txRoot' in block:
+                header = tools.block_header(block)
+                header['nonce'] = block['nonce']
+                out.append(header)
+            else:
+                out.append(block)
+            counter += 1
+        return out
+
+    @sync
+    def state_proof(self, address):
+        """
+        Account of an address with its proof against the state root at our top block.
+        """
+        if not tools.is_address_valid(address):
+            return {'error': 'Invalid address'}
+        snapshot = self.db.reader()
+        account = snapshot.get(address)
+        return {
+            'length': snapshot.length,
+            'hash': snapshot.get(self.blockchain.block_hash_key(snapshot.length)),
+            'account': None if account is None else {'amount': account['amount'], 'count': account['count']},
+            'proof': self.engine.statedb.tree.proof(address, snapshot)
+        }
+
+    @sync
+    def address_history(self, address, after=None):
+        """
+        Txs of an address in ascending order, each with its inclusion proof.
+        Light nodes continue from the last entry they have.
+        """
+        if not tools.is_address_valid(address):
+            return {'error': 'Invalid address'}
+        snapshot = self.db.reader()
+        limit = self.engine.config['peers'].get('max_range', self.engine.config['peers']['download_limit'] + 11)
+        out = []
+        block = None
+        for length, index, directions in self.engine.statedb.get_history(address, reverse=False, after=after,
+                                                                         snapshot=snapshot):
+            if len(out) == limit:
+                break
+            if block is None or block['length'] != length:
+                block = snapshot.get(self.blockchain.block_key(length))
+            proof = tools.tx_merkle_proof(block['txs'], index) if 'txRoot' in block else None
+            out.append([length, index, directions, block['txs'][index], proof,
+                        snapshot.get(self.blockchain.block_hash_key(length))])
+        return out
+
     @sync
     def peers(self):
         return self.clientdb.get_peers()
@@ -155,7 +317,71 @@ class PeerListenService(Service):
         self.blockchain.tx_queue.put(tx)
         return 'success'
 
+    @sync
+    def inventory(self, node_id, txs=None, blocks=None):
+        """
+        Inventory exchange. Remote announces short hashes of txs and blocks.
+        We answer with the ones we lack and our own tx hashes that were not announced to remote yet.
+        :param node_id: Node id of peer table entry at remote address, or remote IP
+        :param txs: Short tx hashes remote has
+        :param blocks: [length, hash] pairs remote has
+        :return: dict of wanted txs, wanted block lengths and our tx inventory
+        """
+        inventory = self.engine.inventory
+        txs = txs if isinstance(txs, list) else []
+        blocks = blocks if isinstance(blocks, list) else []
+
+        wanted = [h for h in txs if not self.blockchain.tx_pool_has(h)]
+        inventory.mark(node_id, txs)
+
+        wanted_blocks = []
+        for length, block_hash in blocks:
+            our_hash = self.blockchain.get_block_hash(length)
+            if our_hash is None or our_hash.hex() != block_hash:
+                wanted_blocks.append(length)
+        inventory.mark(node_id, [h for l, h in blocks])
+
+        offer = inventory.unknown(node_id, self.blockchain.tx_pool_hashes())
+        inventory.mark(node_id, offer)
+        return {
+            'wanted': wanted,
+            'wanted_blocks': wanted_blocks,
+            'txs': offer
+        }
+
+    @sync
+    def get_txs(self, hashes):
+        return self.blockchain.tx_pool_get(hashes)
+
+    @sync
+    def push_txs(self, txs, node_id):
+        self.engine.inventory.mark(node_id, [tools.tx_hash(tx) for tx in txs])
+        for tx in txs:
+            self.blockchain.tx_queue.put(tx)
+        return 'success'
+
+    @sync
+    def compact_block(self, compact, node_id):
+        """
+        A peer relays a new block as header and short tx ids.
+        We rebuild the block from our mempool and queue it. If some txs are missing,
+        their indexes are returned so that remote can send them.
+        :param compact: compact block dict
+        :param node_id: Node id of peer table entry at remote IP, or remote IP
+        :return: dict with status or missing indexes
+        """
+        self.engine.inventory.mark(node_id, [compact['hash']])
+        if compact['header']['length'] != self.db.get('length') + 1:
+            return {'status': 'ignored'}
+        block, missing = self.blockchain.rebuild_compact_block(compact)
+        if block is None:
+            return {'missing': missing}
+        if not self.blockchain.blocks_queue.put(([block], node_id), timeout=1):
+            return {'status': 'busy'}
+        return {'status': 'accepted'}
+
     @sync
     def push_block(self, blocks, node_id):
-        self.blockchain.blocks_queue.put((blocks, node_id))
+        if not self.blockchain.blocks_queue.put((blocks, node_id), timeout=1):
+            return 'busy'
         return 'success'
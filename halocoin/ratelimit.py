@@ -0,0 +1,100 @@
+import time
+from collections import OrderedDict
+
+# action: (tokens per second, bucket capacity). 'bytes' budget is counted in bytes on wire.
+default_limits = {
+    'default': (5, 20),
+    'greetings': (1, 5),
+    'range_request': (0.5, 8),
+    'push_block': (1, 10),
+    'compact_block': (1, 10),
+    'push_tx': (20, 200),
+    'push_txs': (2, 20),
+    'headers': (0.5, 8),
+    'state_proof': (2, 20),
+    'address_history': (1, 10),
+    'bytes': (1024 * 1024, 16 * 1024 * 1024)
+}
+
+
+class TokenBucket:
+    """
+    Classic token bucket. Tokens are refilled continuously at given rate up to capacity.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, amount=1):
+        """
+        :param amount: Number of tokens to take
+        :return: Whether there were enough tokens
+        """
+        self.refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def charge(self, amount):
+        """
+        Take tokens after the fact. Bucket can go into debt which blocks later consumes.
+        """
+        self.refill()
+        self.tokens -= amount
+
+    def available(self):
+        self.refill()
+        return self.tokens
+
+
+class RateLimiter:
+    """
+    Keeps token buckets for every (remote, action) pair and a byte budget for every remote.
+    Remotes are identified by their IP address since node ids are self reported.
+    Least recently seen remotes are forgotten when there are more than max_remotes.
+    """
+
+    def __init__(self, limits=None, max_remotes=1024):
+        self.limits = dict(default_limits)
+        if limits is not None:
+            self.limits.update(limits)
+        self.max_remotes = max_remotes
+        self.remotes = OrderedDict()
+
+    def __buckets(self, remote):
+        if remote not in self.remotes:
+            self.remotes[remote] = {}
+            while len(self.remotes) > self.max_remotes:
+                self.remotes.popitem(last=False)
+        self.remotes.move_to_end(remote)
+        return self.remotes[remote]
+
+    def __bucket(self, remote, name):
+        buckets = self.__buckets(remote)
+        if name not in buckets:
+            rate, capacity = self.limits.get(name, self.limits['default'])
+            buckets[name] = TokenBucket(rate, capacity)
+        return buckets[name]
+
+    def allow(self, remote, action):
+        """
+        :return: Whether remote can execute the action now. Remotes over their byte budget are refused.
+        """
+        if self.__bucket(remote, 'bytes').available() < 0:
+            return False
+        # Actions without their own limit share one bucket, so that made up names cannot add buckets.
+        if action == 'bytes' or action not in self.limits:
+            action = 'default'
+        return self.__bucket(remote, action).consume()
+
+    def charge_bytes(self, remote, amount):
+        self.__bucket(remote, 'bytes').charge(amount)
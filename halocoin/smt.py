@@ -0,0 +1,211 @@
+import hashlib
+
+# Compact sparse Merkle tree over accounts. Every address has a fixed path, sha256(address),
+# in a binary tree of depth 256. A leaf is stored at the first depth where it is alone in its
+# subtree, so a tree of n accounts has about 2n nodes and paths of about log n nodes.
+# Subtree hashes: an empty subtree is EMPTY, a subtree with a single account is the hash of
+# that leaf and any other subtree is the hash of its two children.
+# A node is stored under smt_<depth>_<prefix>, depth 0 being the root. Prefix of a node is
+# the path of any leaf below it shifted right by 256 - depth.
+# Internal nodes are stored as their hash, leaves as [address, amount, count].
+# An account with no balance and no txs is the same as no account and has no leaf, whether or not
+# a record of it is left in the database.
+DEPTH = 256
+EMPTY = bytes(32)
+
+
+def is_empty_account(account):
+    return account is None or (account['amount'] == 0 and account['count'] == 0)
+
+
+def node_hash(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def leaf_hash(address, account):
+    """
+    Only balance and tx count are committed. Other account fields are local bookkeeping.
+    """
+    if is_empty_account(account):
+        return EMPTY
+    leaf = '{}:{}:{}'.format(address, account['amount'], account['count'])
+    return hashlib.sha256(b'\x00' + leaf.encode()).digest()
+
+
+def leaf_path(address):
+    return int.from_bytes(hashlib.sha256(address.encode()).digest(), 'big')
+
+
+def node_key(depth, prefix):
+    return 'smt_{:03d}_{:x}'.format(depth, prefix)
+
+
+def path_bit(path, depth):
+    """
+    :return: Side of the child at depth + 1 that path goes into, 0 for left
+    """
+    return (path >> (DEPTH - 1 - depth)) & 1
+
+
+def subtree_hash(node):
+    if node is None:
+        return EMPTY
+    if isinstance(node, list):
+        return leaf_hash(node[0], {'amount': node[1], 'count': node[2]})
+    return node
+
+
+def verify_proof(root, address, account, proof):
+    """
+    Check that an account is in the state with given root. Works without any database.
+    :param root: State root
+    :param address: Address
+    :param account: Account with amount and count, None or an empty account to prove that address has no account
+    :param proof: Dict with siblings from the root downwards and, for an address without account,
+    the leaf that sits on its path as [address, {'amount': ..., 'count': ...}] or None
+    :return: Whether proof is valid
+    """
+    siblings = proof['siblings']
+    other = proof.get('leaf', None)
+    if len(siblings) > DEPTH:
+        return False
+    path = leaf_path(address)
+    if not is_empty_account(account):
+        if other is not None:
+            return False
+        current = leaf_hash(address, account)
+    elif other is None:
+        current = EMPTY
+    else:
+        other_address, other_account = other
+        shift = DEPTH - len(siblings)
+        if other_address == address or leaf_path(other_address) >> shift != path >> shift:
+            return False
+        current = leaf_hash(other_address, other_account)
+    for depth in range(len(siblings) - 1, -1, -1):
+        if path_bit(path, depth):
+            current = node_hash(siblings[depth], current)
+        else:
+            current = node_hash(current, siblings[depth])
+    return current == root
+
+
+class SparseMerkleTree:
+    """
+    Authenticated index of accounts stored in the same database as accounts.
+    Updating k accounts among n costs about k * log n node reads and writes, sharing the nodes
+    that their paths have in common. Writes go through the database, so they are part of
+    the simulation that adds or removes a block.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_node(self, depth, prefix, store=None):
+        """
+        :return: None for an empty subtree, [address, amount, count] for a leaf or hash of an internal node
+        """
+        return (store if store is not None else self.db).get(node_key(depth, prefix))
+
+    def put_node(self, depth, prefix, node):
+        if node is None:
+            self.db.delete(node_key(depth, prefix))
+        else:
+            self.db.put(node_key(depth, prefix), node)
+
+    def root(self, store=None):
+        return subtree_hash(self.get_node(0, 0, store))
+
+    def update(self, accounts):
+        """
+        :param accounts: Dict of address to its new account, None or an empty account for removed accounts
+        :return: New root
+        """
+        if len(accounts) == 0:
+            return self.root()
+        leaves = {}
+        for address, account in accounts.items():
+            leaves[leaf_path(address)] = None if is_empty_account(account) \
+                else [address, account['amount'], account['count']]
+        node = self.update_subtree(0, 0, leaves)
+        self.put_node(0, 0, node)
+        return subtree_hash(node)
+
+    def update_subtree(self, depth, prefix, leaves):
+        """
+        Apply leaf changes below a node. Nodes below depth are written, the node itself is returned
+        for the caller to write, so that a parent can pull a lone leaf up into its own place.
+        :param leaves: Dict of path to new leaf or None, all paths below prefix
+        :return: New node at depth
+        """
+        node = self.get_node(depth, prefix)
+        if not isinstance(node, bytes):
+            # Subtree holds at most one leaf, build it again with the changes.
+            if node is not None:
+                leaves = dict(leaves)
+                leaves.setdefault(leaf_path(node[0]), node)
+            return self.build_subtree(depth, prefix, {path: leaf for path, leaf in leaves.items()
+                                                      if leaf is not None})
+        sides = ({}, {})
+        for path, leaf in leaves.items():
+            sides[path_bit(path, depth)][path] = leaf
+        children = []
+        for side in (0, 1):
+            child_prefix = (prefix << 1) | side
+            if len(sides[side]) > 0:
+                children.append(self.update_subtree(depth + 1, child_prefix, sides[side]))
+            else:
+                children.append(self.get_node(depth + 1, child_prefix))
+        return self.join_children(depth, prefix, children, [len(side) > 0 for side in sides])
+
+    def build_subtree(self, depth, prefix, leaves):
+        """
+        Write a subtree that is empty below depth.
+        :param leaves: Dict of path to leaf, all paths below prefix
+        :return: New node at depth
+        """
+        if len(leaves) == 0:
+            return None
+        if len(leaves) == 1:
+            return next(iter(leaves.values()))
+        sides = ({}, {})
+        for path, leaf in leaves.items():
+            sides[path_bit(path, depth)][path] = leaf
+        children = [self.build_subtree(depth + 1, (prefix << 1) | side, sides[side]) for side in (0, 1)]
+        # Nothing is stored below depth yet, so empty children need no delete.
+        return self.join_children(depth, prefix, children, [child is not None for child in children])
+
+    def join_children(self, depth, prefix, children, changed):
+        """
+        Write children of a node and return the node. A lone leaf moves up instead of being written.
+        """
+        left, right = children
+        if (left is None or isinstance(left, list)) and (right is None or isinstance(right, list)) and \
+                (left is None or right is None):
+            for side in (0, 1):
+                if children[side] is not None or changed[side]:
+                    self.put_node(depth + 1, (prefix << 1) | side, None)
+            return left if left is not None else right
+        for side in (0, 1):
+            if changed[side]:
+                self.put_node(depth + 1, (prefix << 1) | side, children[side])
+        return node_hash(subtree_hash(left), subtree_hash(right))
+
+    def proof(self, address, store=None):
+        """
+        :param address: Address
+        :param store: Database or snapshot to read from
+        :return: Proof for verify_proof
+        """
+        path = leaf_path(address)
+        siblings = []
+        for depth in range(DEPTH + 1):
+            node = self.get_node(depth, path >> (DEPTH - depth), store)
+            if not isinstance(node, bytes):
+                other = None
+                if node is not None and node[0] != address:
+                    other = [node[0], {'amount': node[1], 'count': node[2]}]
+                return {'siblings': siblings, 'leaf': other}
+            sibling_prefix = (path >> (DEPTH - depth - 1)) ^ 1
+            siblings.append(subtree_hash(self.get_node(depth + 1, sibling_prefix, store)))
+        return {'siblings': siblings, 'leaf': None}
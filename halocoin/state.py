@@ -1,7 +1,9 @@
 import copy
+import itertools
 
 from halocoin import tools
 from halocoin.service import lockit
+from halocoin.smt import SparseMerkleTree, is_empty_account
 
 
 class StateDatabase:
@@ -16,14 +18,14 @@ class StateDatabase:
     default_account = {
         'amount': 0,
         'count': 0,
-        'cache-length': -1,
-        'tx_blocks': []
+        'cache-length': -1
     }
 
     def __init__(self, engine):
         self.engine = engine
         self.db = self.engine.db
         self.blockchain = self.engine.blockchain
+        self.tree = SparseMerkleTree(self.db)
 
     @lockit('kvstore')
     def get_account(self, address, apply_tx_pool=False):
@@ -47,11 +49,32 @@ class StateDatabase:
             txs = self.blockchain.tx_pool()
             account = update_account_with_txs(address, account, txs)
 
-        if 'tx_blocks' not in account:
-            account['tx_blocks'] = []
+        # History of an address lives in its own index. Older records may still carry the list.
+        account.pop('tx_blocks', None)
 
         return account
 
+    def get_accounts(self, addresses, snapshot=None):
+        """
+        Read several accounts from a single database snapshot.
+        :param addresses: List of addresses
+        :param snapshot: Snapshot to read from. Latest committed state is used if not given.
+        :return: Chain length that accounts were read at and dict of address to account
+        :raises ValueError: if an address is not valid. Other records of database are not accounts.
+        """
+        if snapshot is None:
+            snapshot = self.db.reader()
+        accounts = {}
+        for address in addresses:
+            if not tools.is_address_valid(address):
+                raise ValueError('{} is not a valid address'.format(address))
+            account = snapshot.get(address)
+            if account is None:
+                account = copy.deepcopy(StateDatabase.default_account)
+            account.pop('tx_blocks', None)
+            accounts[address] = account
+        return snapshot.length, accounts
+
     @lockit('kvstore')
     def remove_account(self, address):
         self.db.delete(address)
@@ -79,10 +102,8 @@ class StateDatabase:
 
             send_account['amount'] -= tx['amount']
             send_account['count'] += 1
-            send_account['tx_blocks'].append(block_length)
 
             recv_account['amount'] += tx['amount']
-            recv_account['tx_blocks'].append(block_length)
 
             if (recv_account['amount'] < 0) or (send_account['amount'] < 0):
                 return False
@@ -103,13 +124,213 @@ class StateDatabase:
 
         txs = sorted(block['txs'], key=lambda x: x['count'] if 'count' in x else -1)
 
+        # Remember what this block overwrites so that it can be removed without replaying txs backwards.
+        touched = StateDatabase.touched_addresses(block)
+        undo = {address: copy.deepcopy(self.db.get(address)) for address in touched}
+
         for tx in txs:
             result = self.update_database_with_tx(tx, block['length'])
             if not result:
                 return False
 
+        root = self.tree.update({address: self.db.get(address) for address in touched})
+        self.db.put(StateDatabase.root_key(block['length']), root)
+        self.put_history(block)
+        self.db.put(StateDatabase.undo_key(block['length']), undo)
+        # Blocks deeper than the longest allowed reorg are never rolled back.
+        max_depth = self.engine.config.get('blockchain', {}).get('max_reorg_depth', 1000)
+        if block['length'] - max_depth - 1 >= 0:
+            self.db.delete(StateDatabase.undo_key(block['length'] - max_depth - 1))
         return True
 
+    @staticmethod
+    def touched_addresses(block):
+        touched = set()
+        for tx in block['txs']:
+            touched.add(tools.tx_owner_address(tx))
+            if tx['type'] == 'spend':
+                touched.add(tx['to'])
+        return touched
+
+    @staticmethod
+    def undo_key(length):
+        return 'undo_' + str(length).zfill(12)
+
+    @staticmethod
+    def root_key(length):
+        return 'stateroot_' + str(length).zfill(12)
+
+    def get_state_root(self, length, snapshot=None):
+        """
+        :param length: Block length
+        :param snapshot: Snapshot to read from. Latest committed state is used if not given.
+        :return: Root of account state after the block at length, None if it is not known
+        """
+        if snapshot is None:
+            snapshot = self.db.reader()
+        return snapshot.get(StateDatabase.root_key(length))
+
+    def delete_range(self, start, stop, batch_size=10000):
+        """
+        Remove committed records between start and stop, in batches.
+        :return: None
+        """
+        while True:
+            keys = [key for key, value in itertools.islice(self.db.iterate(start, stop), batch_size)]
+            if len(keys) == 0:
+                return
+            self.db.simulate()
+            for key in keys:
+                self.db.delete(key)
+            self.db.commit()
+
+    def migrate_state_tree(self, batch_size=10000):
+        """
+        Build state tree from accounts that existed before the compact tree did.
+        Nodes and roots of the earlier layout, which kept every leaf at depth 256, are removed first.
+        Accounts are added in batches so that a large state does not pile up in a single simulation.
+        Records of empty accounts that rollbacks left behind are removed, they are not part of the tree.
+        :return: None
+        """
+        if self.db.get('smt_compact'):
+            return
+        # Node keys continue with a digit, markers with a letter.
+        self.delete_range('smt_0', 'smt_:', batch_size)
+        self.delete_range('stateroot_', 'stateroot_:', batch_size)
+        length = self.db.get('length')
+        batch = {}
+        for address, account in self.db.iterate('0', ':'):
+            if not tools.is_address_valid(address):
+                continue
+            batch[address] = account
+            if len(batch) == batch_size:
+                self.db.simulate()
+                self.add_to_tree(batch)
+                self.db.commit()
+                batch = {}
+        self.db.simulate()
+        root = self.add_to_tree(batch)
+        if length is not None and length >= 0:
+            self.db.put(StateDatabase.root_key(length), root)
+        self.db.delete('smt_built')
+        self.db.put('smt_compact', True)
+        self.db.commit()
+
+    def add_to_tree(self, accounts):
+        """
+        Add existing accounts to state tree, removing records of empty accounts.
+        :param accounts: Dict of address to account
+        :return: New root
+        """
+        for address, account in accounts.items():
+            if is_empty_account(account):
+                self.db.delete(address)
+        return self.tree.update(accounts)
+
+    @staticmethod
+    def history_key(address, length, tx_index):
+        return 'addrtx_{}_{}_{}'.format(address, str(length).zfill(12), str(tx_index).zfill(6))
+
+    @staticmethod
+    def history_entries(block):
+        """
+        Address history entries that a block creates. Mint txs are not part of history.
+        :param block: Block
+        :return: Dict of history key to directions of the tx for that address
+        """
+        entries = {}
+        for tx_index, tx in enumerate(block['txs']):
+            if tx['type'] != 'spend':
+                continue
+            owner_key = StateDatabase.history_key(tools.tx_owner_address(tx), block['length'], tx_index)
+            recv_key = StateDatabase.history_key(tx['to'], block['length'], tx_index)
+            entries.setdefault(owner_key, []).append('send')
+            entries.setdefault(recv_key, []).append('recv')
+        return entries
+
+    def put_history(self, block):
+        for key, directions in StateDatabase.history_entries(block).items():
+            self.db.put(key, directions)
+
+    def delete_history(self, block):
+        for key in StateDatabase.history_entries(block).keys():
+            self.db.delete(key)
+
+    def get_history(self, address, reverse=True, after=None, snapshot=None):
+        """
+        Txs that an address sent or received, read from address history index.
+        :param address: Address
+        :param reverse: Newest first
+        :param after: (block length, tx index) of the last entry that was already seen.
+        Iteration continues from the next entry in the same order.
+        :param snapshot: Snapshot to read from. Latest committed state is used if not given.
+        :return: Generator of (block length, tx index, directions)
+        """
+        prefix = 'addrtx_{}_'.format(address)
+        start, stop = prefix, prefix + '~'
+        if after is not None and reverse:
+            stop = StateDatabase.history_key(address, after[0], after[1])
+        elif after is not None:
+            start = StateDatabase.history_key(address, after[0], after[1]) + '~'
+        if snapshot is None:
+            snapshot = self.db.reader()
+        for key, directions in snapshot.iterate(start, stop, reverse=reverse):
+            length, tx_index = key[len(prefix):].split('_')
+            yield int(length), int(tx_index), directions
+
+    def migrate_history(self, batch_size=1000):
+        """
+        Earlier versions kept a list of block lengths in every account.
+        Build address history index from the chain once and drop those lists.
+        Blocks are indexed in batches so that a long chain does not pile up in a single simulation.
+        Length indexed so far is kept under 'addrtx_progress', an interrupted migration continues from there.
+        :return: None
+        """
+        if self.db.get('addrtx_indexed'):
+            return
+        length = self.db.get('length')
+        if length is None:
+            length = -1
+        if length >= 0:
+            print('Building address history index')
+        start = self.db.get('addrtx_progress')
+        start = 0 if start is None else start + 1
+        for batch_start in range(start, length + 1, batch_size):
+            batch_end = min(batch_start + batch_size, length + 1)
+            self.db.simulate()
+            addresses = set()
+            for i in range(batch_start, batch_end):
+                block = self.blockchain.get_block(i)
+                self.put_history(block)
+                for tx in block['txs']:
+                    addresses.add(tools.tx_owner_address(tx))
+                    if tx['type'] == 'spend':
+                        addresses.add(tx['to'])
+            for address in addresses:
+                account = self.db.get(address)
+                if account is not None and 'tx_blocks' in account:
+                    del account['tx_blocks']
+                    self.db.put(address, account)
+            self.db.put('addrtx_progress', batch_end - 1)
+            self.db.commit()
+        self.db.simulate()
+        self.db.delete('addrtx_progress')
+        self.db.put('addrtx_indexed', True)
+        self.db.commit()
+
+    def get_state_root_after(self, block):
+        """
+        Root that account state would have after adding a block. Nothing is written.
+        :param block: Candidate block with txs that are valid together
+        :return: State root
+        """
+        self.db.simulate()
+        try:
+            self.update_database_with_block(block)
+            return self.tree.root()
+        finally:
+            self.db.rollback()
+
     def get_valid_txs_for_next_block(self, txs, new_length):
         txs = sorted(txs, key=lambda x: x['count'] if 'count' in x else -1)
         valid_txs = []
@@ -136,6 +357,31 @@ class StateDatabase:
             # Block is not at the top the chain
             return False
 
+        self.delete_history(block)
+        undo = self.db.get(StateDatabase.undo_key(block['length']))
+        if undo is not None:
+            # Restore the accounts exactly as they were before this block.
+            for address, account in undo.items():
+                if account is None:
+                    self.db.delete(address)
+                else:
+                    self.db.put(address, account)
+            self.db.delete(StateDatabase.undo_key(block['length']))
+        else:
+            # Blocks that were added before undo records existed are reverted tx by tx.
+            self.reverse_block_txs(block)
+
+        touched = StateDatabase.touched_addresses(block)
+        self.tree.update({address: self.db.get(address) for address in touched})
+        self.db.delete(StateDatabase.root_key(block['length']))
+        return True
+
+    def reverse_block_txs(self, block):
+        """
+        Revert txs of a block one by one. Accounts that end up empty are removed, as if they never existed.
+        :param block: Block to be reverted
+        :return: None
+        """
         for tx in block['txs']:
             tx_owner_address = tools.tx_owner_address(tx)
             owner_account = self.get_account(tx_owner_address)
@@ -145,14 +391,15 @@ class StateDatabase:
             elif tx['type'] == 'spend':
                 owner_account['amount'] += tx['amount']
                 owner_account['count'] -= 1
-                owner_account['tx_blocks'].remove(block['length'])
 
-                receiver_account = self.db.get(tx['to'])
+                receiver_account = self.get_account(tx['to'])
                 receiver_account['amount'] -= tx['amount']
-                receiver_account['tx_blocks'].remove(block['length'])
 
                 self.db.put(tx_owner_address, owner_account)
                 self.db.put(tx['to'], receiver_account)
+        for address in StateDatabase.touched_addresses(block):
+            if is_empty_account(self.db.get(address)):
+                self.db.delete(address)
 
     @lockit('kvstore')
     def known_tx_count(self, address, count_pool=True, txs_in_pool=None):
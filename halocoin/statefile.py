@@ -0,0 +1,57 @@
+import hashlib
+import io
+import pickle
+import struct
+
+from halocoin.blockfile import SafeUnpickler
+
+# State files start with this header. Every record is 4 bytes of payload size followed by
+# a pickled tuple. First record is ('header', info), then ('account', address, account) records
+# in address order, then ('block', block) records in length order and finally ('trailer', info).
+MAGIC = b'HALOCOIN-STATE-1\n'
+RECORD_SIZE = struct.Struct('>I')
+
+
+class StateHasher:
+    """
+    Hash of account state. Accounts must be added in address order.
+    Only amount and count are part of the state, local bookkeeping fields are not.
+    """
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+
+    def add(self, address, account):
+        self.sha.update('{}:{}:{}\n'.format(address, account['amount'], account['count']).encode())
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+def write_record(f, *record):
+    payload = pickle.dumps(record)
+    f.write(RECORD_SIZE.pack(len(payload)))
+    f.write(payload)
+
+
+def read_records(f):
+    """
+    :param f: File object opened in binary mode
+    :return: Generator of record tuples
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a halocoin state file')
+    while True:
+        header = f.read(RECORD_SIZE.size)
+        if len(header) == 0:
+            return
+        if len(header) < RECORD_SIZE.size:
+            raise ValueError('State file is truncated')
+        size = RECORD_SIZE.unpack(header)[0]
+        payload = f.read(size)
+        if len(payload) < size:
+            raise ValueError('State file is truncated')
+        record = SafeUnpickler(io.BytesIO(payload)).load()
+        if not isinstance(record, tuple) or len(record) == 0:
+            raise ValueError('Malformed record in state file')
+        yield record
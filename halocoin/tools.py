@@ -1,5 +1,6 @@
 import copy
 import hashlib
+import ipaddress
 import logging
 import os
 import random
@@ -66,10 +67,87 @@ def det_hash(x):
     return hashlib.sha384(yaml.dump(x).encode()).digest()[0:32]
 
 
-def hash_without_nonce(block):
+def tx_hash(tx):
+    """Short identifier of a transaction. Used while announcing txs to peers."""
+    return det_hash(tx)[:8].hex()
+
+
+def block_hash(block):
+    """Hash that identifies a block. The next block refers to it by prevHash.
+    Blocks with a tx root are identified by their proof of work hash, which covers only the header."""
+    if 'txRoot' in block:
+        return det_hash(hash_without_nonce(block))
+    return det_hash(block)
+
+
+# Fields that make up a block header. Txs are committed through txRoot, account state through stateRoot.
+header_fields = ['version', 'length', 'time', 'target', 'diffLength', 'prevHash', 'txRoot', 'stateRoot']
+
+
+def block_header(block):
+    return {key: block[key] for key in header_fields if key in block}
+
+
+def half_hash(block):
+    """Hash of a block without its nonce. Miners compute it once per candidate block."""
+    if 'txRoot' in block:
+        return det_hash(block_header(block))
     a = copy.deepcopy(block)
-    a.pop('nonce')
-    return {'nonce': block['nonce'], 'halfHash': det_hash(a)}
+    a.pop('nonce', None)
+    return det_hash(a)
+
+
+def hash_without_nonce(block):
+    return {'nonce': block['nonce'], 'halfHash': half_hash(block)}
+
+
+def merkle_leaf(tx):
+    return hashlib.sha256(b'\x00' + det_hash(tx)).digest()
+
+
+def merkle_node(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def merkle_levels(txs):
+    """
+    Levels of tx Merkle tree from leaves to root. Last node of a level with odd number of nodes
+    moves up unchanged, so no tx list can have the same root as another one with a duplicated tx.
+    """
+    levels = [[merkle_leaf(tx) for tx in txs]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([merkle_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                       for i in range(0, len(level), 2)])
+    return levels
+
+
+def tx_merkle_root(txs):
+    if len(txs) == 0:
+        return bytes(32)
+    return merkle_levels(txs)[-1][0]
+
+
+def tx_merkle_proof(txs, index):
+    """
+    :param txs: Txs of a block
+    :param index: Position of the tx to prove
+    :return: List of [side, hash] from leaf to root. side is 'l' if sibling is on the left.
+    """
+    proof = []
+    for level in merkle_levels(txs)[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(['l' if sibling < index else 'r', level[sibling]])
+        index //= 2
+    return proof
+
+
+def verify_tx_proof(root, tx, proof):
+    current = merkle_leaf(tx)
+    for side, sibling in proof:
+        current = merkle_node(sibling, current) if side == 'l' else merkle_node(current, sibling)
+    return current == root
 
 
 def base58_encode(num):
@@ -97,6 +175,14 @@ def is_address_valid(address):
     return True
 
 
+def is_ip_address(value):
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+
 def make_address(pubkeys, n):
     """
     n is the number of pubkeys required to spend from this address.
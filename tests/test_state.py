@@ -0,0 +1,83 @@
+import shutil
+import tempfile
+import unittest
+
+from halocoin import tools
+from halocoin.database import KeyValueStore
+from halocoin.state import StateDatabase
+
+
+class Engine:
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+        self.config = {}
+        self.blockchain = None
+        self.db = KeyValueStore(self, 'db')
+
+
+def mint(pubkey):
+    return {'type': 'mint', 'pubkeys': [pubkey], 'signatures': ['sig']}
+
+
+def spend(pubkey, to, amount, count):
+    return {'type': 'spend', 'pubkeys': [pubkey], 'signatures': ['sig'], 'to': to, 'amount': amount, 'count': count}
+
+
+class StateRootTest(unittest.TestCase):
+    def setUp(self):
+        self.dirs = []
+        self.alice = tools.make_address([b'alice'], 1)
+        self.bob = tools.make_address([b'bob'], 1)
+        self.blocks = [
+            {'length': 0, 'txs': [mint(b'alice')]},
+            {'length': 1, 'txs': [mint(b'alice'), spend(b'alice', self.bob, 5, 0)]},
+        ]
+
+    def tearDown(self):
+        for working_dir in self.dirs:
+            shutil.rmtree(working_dir)
+
+    def new_state(self, blocks):
+        self.dirs.append(tempfile.mkdtemp())
+        engine = Engine(self.dirs[-1])
+        statedb = StateDatabase(engine)
+        for block in blocks:
+            engine.db.simulate()
+            self.assertTrue(statedb.update_database_with_block(block))
+            engine.db.put('length', block['length'])
+            engine.db.commit()
+        return statedb
+
+    def rollback_top(self, statedb, without_undo=False):
+        db = statedb.db
+        block = self.blocks[db.get('length')]
+        db.simulate()
+        if without_undo:
+            db.delete(StateDatabase.undo_key(block['length']))
+        self.assertTrue(statedb.rollback_block(block))
+        db.put('length', block['length'] - 1)
+        db.commit()
+
+    def test_rollback_matches_fresh_state(self):
+        fresh = self.new_state(self.blocks[:1])
+        for without_undo in (False, True):
+            statedb = self.new_state(self.blocks)
+            self.rollback_top(statedb, without_undo)
+            self.assertIsNone(statedb.db.get(self.bob))
+            self.assertEqual(statedb.tree.root(), fresh.tree.root())
+
+    def test_migration_skips_empty_accounts(self):
+        fresh = self.new_state(self.blocks[:1])
+        statedb = self.new_state(self.blocks[:1])
+        db = statedb.db
+        # Records that earlier versions left behind after a rollback.
+        db.put(self.bob, {'amount': 0, 'count': 0, 'cache-length': -1})
+        db.delete('smt_compact')
+        statedb.migrate_state_tree(batch_size=1)
+        self.assertIsNone(db.get(self.bob))
+        self.assertEqual(statedb.tree.root(), fresh.tree.root())
+        self.assertEqual(statedb.get_state_root(0), fresh.tree.root())
+
+
+if __name__ == '__main__':
+    unittest.main()